@@ -1,6 +1,8 @@
 import asyncio
 import os
 
+from utils.startup import startup_timer
+
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 
@@ -8,9 +10,11 @@ from dotenv import find_dotenv, load_dotenv
 
 load_dotenv(find_dotenv())
 
-from middlewares.db import DataBaseSession
+from middlewares.db import DataBaseSession, SqlHandlerNameMiddleware, SqlStatsMiddleware
 
 from database.engine import create_db, drop_db, session_maker
+from database.key_pool import key_pool
+from database.orm_query import orm_archive_keys, orm_release_expired_reservations
 
 from handlers.user_private import user_private_router
 from handlers.user_group import user_group_router
@@ -18,6 +22,10 @@ from handlers.admin_private import admin_router
 
 from common.bot_cmds_list import private
 
+from utils.notices import send_expiry_notices
+from utils.outbound import outbound
+from utils.periodic import periodic_jobs
+
 
 # ALLOWED_UPDATES = ['message', 'edited_message', 'callback_query']
 
@@ -30,16 +38,34 @@ dp.include_router(user_private_router)
 dp.include_router(user_group_router)
 dp.include_router(admin_router)
 
+# Как часто снимать истёкшие резервы ключей (в секундах)
+RESERVATION_SWEEP_INTERVAL = int(os.getenv('RESERVATION_SWEEP_SECONDS', 60))
+periodic_jobs.add('release_expired_reservations', RESERVATION_SWEEP_INTERVAL, orm_release_expired_reservations)
+# Как часто проверять ключи, по которым пора отправить уведомление об окончании срока (в секундах)
+EXPIRY_NOTICE_INTERVAL = int(os.getenv('EXPIRY_NOTICE_SECONDS', 600))
+periodic_jobs.add('expiry_notices', EXPIRY_NOTICE_INTERVAL, send_expiry_notices)
+# Как часто переносить отработавшие ключи в архив (в секундах)
+KEY_ARCHIVE_INTERVAL = int(os.getenv('KEY_ARCHIVE_SECONDS', 3600))
+periodic_jobs.add('archive_keys', KEY_ARCHIVE_INTERVAL, orm_archive_keys)
+
 
 async def on_startup(bot):
 
     # await drop_db()
 
     await create_db()
+    async with startup_timer.step("пул ключей"):
+        await key_pool.start(session_maker)
+    periodic_jobs.start(session_maker)
+    outbound.start(bot)
+    print(startup_timer.report())
 
 
 async def on_shutdown(bot):
     print('бот лег')
+    await periodic_jobs.stop()
+    await key_pool.stop()
+    await outbound.stop()
     await bot.session.close()
 
 
@@ -47,11 +73,18 @@ async def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
+    dp.update.outer_middleware(SqlStatsMiddleware())
     dp.update.middleware(DataBaseSession(session_pool=session_maker))
-
-    await bot.delete_webhook(drop_pending_updates=True)
-    # await bot.delete_my_commands(scope=types.BotCommandScopeAllPrivateChats())
-    await bot.set_my_commands(commands=private, scope=types.BotCommandScopeAllPrivateChats())
+    dp.message.middleware(SqlHandlerNameMiddleware())
+    dp.callback_query.middleware(SqlHandlerNameMiddleware())
+
+    # Независимые запросы к Telegram выполняем параллельно
+    async with startup_timer.step("настройка бота в Telegram"):
+        await asyncio.gather(
+            bot.delete_webhook(drop_pending_updates=True),
+            # bot.delete_my_commands(scope=types.BotCommandScopeAllPrivateChats()),
+            bot.set_my_commands(commands=private, scope=types.BotCommandScopeAllPrivateChats()),
+        )
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 #asyncio.run(main())
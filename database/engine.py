@@ -1,10 +1,13 @@
 import os
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
+from database.migrations import run_migrations, schema_is_current
 from database.models import Base
-from database.orm_query import orm_add_banner_description, orm_create_categories
+from database.sql_stats import install_sql_stats
+from database.orm_query import orm_add_banner_description, orm_create_categories, orm_recount_available_keys
 
 from common.texts_for_db import categories, description_for_info_pages
+from utils.startup import startup_timer
 
 #from .env file:
 # DB_LITE=sqlite+aiosqlite:///my_base.db
@@ -12,19 +15,44 @@ from common.texts_for_db import categories, description_for_info_pages
 
 # engine = create_async_engine(os.getenv('DB_LITE'), echo=True)
 
-engine = create_async_engine(os.getenv('DB_URL'), echo=True)
+DB_URL = os.getenv('DB_URL')
+
+# asyncpg готовит каждый запрос на сервере; подготовленные запросы кэшируются в соединении,
+# чтобы повторные запросы не разбирались Postgres заново (0 - выключить кэш)
+connect_args = {}
+if DB_URL and DB_URL.startswith('postgresql+asyncpg'):
+    connect_args['prepared_statement_cache_size'] = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500))
+
+# Вывод всех SQL-запросов в консоль (DB_ECHO=1) - только для отладки; статистика
+# запросов по хендлерам всегда доступна администратору командой /stats
+DB_ECHO = os.getenv('DB_ECHO', '').lower() in ('1', 'true', 'yes')
+
+engine = create_async_engine(DB_URL, echo=DB_ECHO, connect_args=connect_args)
+install_sql_stats(engine)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
 
 async def create_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-        
-    async with session_maker() as session:
-        await orm_create_categories(session, categories)
-        await orm_add_banner_description(session, description_for_info_pages)
+    # Схема и начальные данные создаются один раз; при обычном перезапуске
+    # вместо create_all и заполнения справочников - один запрос к schema_version
+    async with startup_timer.step("проверка версии схемы"):
+        current = await schema_is_current(engine)
+    if not current:
+        async with startup_timer.step("создание схемы и миграции"):
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await run_migrations(conn)
+        async with startup_timer.step("начальные данные"):
+            async with session_maker() as session:
+                await orm_create_categories(session, categories)
+                await orm_add_banner_description(session, description_for_info_pages)
+
+    async with startup_timer.step("пересчёт остатков ключей"):
+        async with session_maker() as session:
+            # Сверяем счётчики остатков с таблицей ключей (на случай правок БД в обход бота)
+            await orm_recount_available_keys(session)
 
 
 async def drop_db():
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import socket
+from collections import defaultdict, deque
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database.models import Key
+
+
+# Пул заранее зарезервированных свободных ключей по каждому товару.
+# Ключи пула помечаются в БД владельцем (Key.pool_owner), поэтому покупка забирает
+# id ключей из памяти за O(1) и обновляет их по первичному ключу, без поиска used == 0.
+# Пул пополняется пачками в фоне, когда в нём остаётся меньше low_watermark ключей.
+class KeyPool:
+    def __init__(self, batch_size: int=50, low_watermark: int=10):
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"[:64]
+        self.session_pool: async_sessionmaker | None = None
+        self._pools: dict[int, deque[int]] = defaultdict(deque)
+        self._locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._refills: dict[int, asyncio.Task] = {}
+
+    async def start(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+        # Бот работает в режиме polling, а getUpdates может получать только один процесс,
+        # поэтому все резервы при старте - это резервы упавшего предыдущего запуска
+        async with session_pool() as session:
+            await session.execute(
+                update(Key)
+                .where(Key.pool_owner.isnot(None), Key.used == 0)
+                .values(pool_owner=None)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        self._pools.clear()
+
+    async def stop(self):
+        for task in self._refills.values():
+            task.cancel()
+        self._refills.clear()
+
+    async def claim(self, product_id: int, quantity: int) -> list[int]:
+        # Возвращает до quantity id ключей; меньше - если свободных ключей не осталось
+        pool = self._pools[product_id]
+        if len(pool) < quantity:
+            async with self._locks[product_id]:
+                if len(pool) < quantity:
+                    await self._refill(product_id, quantity - len(pool) + self.batch_size)
+        ids = [pool.popleft() for _ in range(min(quantity, len(pool)))]
+        if len(pool) < self.low_watermark:
+            self._schedule_refill(product_id)
+        return ids
+
+    def release(self, product_id: int, ids: list[int]):
+        # Вернуть в пул ключи неудавшейся покупки (в БД они по-прежнему за этим воркером)
+        self._pools[product_id].extendleft(reversed(ids))
+
+    def discard(self, product_id: int):
+        # Забыть пул товара (например, после массового удаления его ключей)
+        self._pools.pop(product_id, None)
+
+    def _schedule_refill(self, product_id: int):
+        task = self._refills.get(product_id)
+        if task and not task.done():
+            return
+        self._refills[product_id] = asyncio.create_task(self._background_refill(product_id))
+
+    async def _background_refill(self, product_id: int):
+        try:
+            async with self._locks[product_id]:
+                if len(self._pools[product_id]) < self.low_watermark:
+                    await self._refill(product_id, self.batch_size)
+        except Exception as e:
+            logging.error(f"Не удалось пополнить пул ключей товара {product_id}: {e}")
+
+    async def _refill(self, product_id: int, count: int):
+        # Отдельная короткая транзакция: резерв не должен откатываться вместе с покупкой
+        async with self.session_pool() as session:
+            query = (
+                select(Key.id)
+                .where(
+                    Key.product_id == product_id,
+                    Key.used == 0,
+                    Key.pool_owner.is_(None),
+                    Key.reserved_for.is_(None),
+                )
+                .order_by(Key.id)
+                .limit(count)
+                .with_for_update(skip_locked=True)
+            )
+            ids = (await session.execute(query)).scalars().all()
+            if not ids:
+                return
+            await session.execute(
+                update(Key)
+                .where(Key.id.in_(ids))
+                .values(pool_owner=self.owner)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        self._pools[product_id].extend(ids)
+
+
+key_pool = KeyPool()
@@ -0,0 +1,154 @@
+import logging
+from typing import Callable
+
+from sqlalchemy import Connection, bindparam, delete, func, inspect, select, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from database.models import Base, Cart, Key, KeyArchive, SchemaVersion
+from utils.key_import import key_hash
+
+
+# Встроенные миграции схемы. create_all создаёт только отсутствующие таблицы,
+# поэтому новые колонки и индексы существующих таблиц добавляются здесь.
+# Каждая миграция идемпотентна (проверяет, что уже есть в БД), поэтому на новой БД,
+# созданной create_all по актуальным моделям, она просто отмечается применённой.
+# Номер последней применённой миграции хранится в таблице schema_version.
+# Если схема уже на LATEST_VERSION, create_db не вызывает create_all, поэтому
+# новая таблица или колонка в моделях требует новой миграции (хотя бы пустой
+# для таблиц - create_all запустится перед ней).
+
+
+def _add_missing_columns(conn: Connection):
+    # Колонки моделей, которых нет в таблицах старых БД (пул ключей, резервы,
+    # заказы, key_hash...). Внешние ключи к существующим таблицам не добавляются -
+    # SQLite не умеет ALTER TABLE ADD CONSTRAINT.
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(conn.dialect)}"
+            default = column.default.arg if column.default is not None and column.default.is_scalar else None
+            if default is not None:
+                ddl += f" DEFAULT {default!r}" if isinstance(default, str) else f" DEFAULT {default}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            conn.exec_driver_sql(ddl)
+            logging.info(f"Миграция: добавлена колонка {table.name}.{column.name}")
+
+
+def _merge_cart_duplicates(conn: Connection):
+    # Перед уникальным индексом по (user_id, product_id) сливаем повторяющиеся строки
+    # корзины в одну (с наименьшим id), складывая количество
+    duplicates = conn.execute(
+        select(Cart.user_id, Cart.product_id, func.min(Cart.id), func.sum(Cart.quantity))
+        .group_by(Cart.user_id, Cart.product_id)
+        .having(func.count(Cart.id) > 1)
+    ).all()
+    for user_id, product_id, keep_id, quantity in duplicates:
+        conn.execute(update(Cart).where(Cart.id == keep_id).values(quantity=quantity))
+        conn.execute(delete(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id, Cart.id != keep_id))
+    if duplicates:
+        logging.info(f"Миграция: объединено повторяющихся строк корзины: {len(duplicates)}")
+
+
+def _create_indexes(conn: Connection):
+    _merge_cart_duplicates(conn)
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # Индексы по колонкам, которые добавит более поздняя миграция, создаст она же
+            if all(column.name in existing for column in index.columns):
+                index.create(conn, checkfirst=True)
+
+
+def _backfill_key_hashes(conn: Connection, batch_size: int=1000):
+    # Отпечатки для ключей, добавленных до появления key_hash (нужны для поиска дублей при импорте)
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(Key.id, Key.key_value)
+            .where(Key.id > last_id, Key.key_hash.is_(None), Key.key_value.isnot(None))
+            .order_by(Key.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        conn.execute(
+            update(Key).where(Key.id == bindparam("key_id")).values(key_hash=bindparam("value_hash")),
+            [{"key_id": key_id, "value_hash": key_hash(key_value)} for key_id, key_value in rows],
+        )
+        last_id = rows[-1].id
+
+
+def _replace_key_name_index(conn: Connection):
+    # Обычный индекс по keys.name не помогал поиску по началу названия - заменяем
+    # его индексом под LIKE своего диалекта (см. Key.__table_args__)
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_keys_name")
+    _create_indexes(conn)
+
+
+def _key_archive_own_ids(conn: Connection):
+    # Раньше id архива совпадал с id ключа; теперь он свой, а id ключа - в key_id
+    _add_missing_columns(conn)
+    conn.execute(update(KeyArchive).where(KeyArchive.key_id.is_(None)).values(key_id=KeyArchive.id))
+    if conn.dialect.name == "postgresql":
+        # Колонка создавалась без автоинкремента - подключаем к ней последовательность
+        id_column = next(column for column in inspect(conn).get_columns("key_archive") if column["name"] == "id")
+        if id_column["default"] is None:
+            conn.exec_driver_sql("CREATE SEQUENCE IF NOT EXISTS key_archive_id_seq OWNED BY key_archive.id")
+            conn.exec_driver_sql("SELECT setval('key_archive_id_seq', COALESCE((SELECT MAX(id) FROM key_archive), 0) + 1, false)")
+            conn.exec_driver_sql("ALTER TABLE key_archive ALTER COLUMN id SET DEFAULT nextval('key_archive_id_seq')")
+    # В SQLite INTEGER PRIMARY KEY и так назначается автоматически
+    _create_indexes(conn)
+
+
+# (версия, описание, функция миграции); новые миграции добавляются в конец
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Новые колонки существующих таблиц", _add_missing_columns),
+    (2, "Индексы частых запросов и уникальные строки корзины", _create_indexes),
+    (3, "key_hash для ключей, добавленных до импорта", _backfill_key_hashes),
+    (4, "Индекс keys.order_id (ключи, закреплённые за заказами)", _create_indexes),
+    (5, "Индекс keys.name для поиска по началу названия", _replace_key_name_index),
+    (6, "Собственный id архива ключей, id ключа - в key_id", _key_archive_own_ids),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _current_version(conn: Connection) -> int:
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def _migrate(conn: Connection) -> list[int]:
+    current = _current_version(conn)
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        migration(conn)
+        conn.execute(SchemaVersion.__table__.insert().values(version=version, description=description))
+        applied.append(version)
+        logging.info(f"Миграция {version} применена: {description}")
+    return applied
+
+
+# Применяет недостающие миграции в одной транзакции, возвращает номера применённых
+async def run_migrations(conn: AsyncConnection) -> list[int]:
+    return await conn.run_sync(_migrate)
+
+
+# Одна проверка при запуске: схема уже на последней версии (таблицы schema_version
+# на новой БД ещё нет - тогда тоже False)
+async def schema_is_current(engine: AsyncEngine) -> bool:
+    try:
+        async with engine.connect() as conn:
+            return await conn.run_sync(_current_version) >= LATEST_VERSION
+    except DBAPIError:
+        return False
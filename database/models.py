@@ -1,4 +1,4 @@
-from sqlalchemy import DateTime, ForeignKey, Numeric, String, Text, BigInteger, func
+from sqlalchemy import DateTime, ForeignKey, Index, Integer, Numeric, String, Text, BigInteger, UniqueConstraint, func, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -34,7 +34,7 @@ class Product(Base):
     price: Mapped[float] = mapped_column(Numeric(5, 2), nullable=False)
     image: Mapped[str] = mapped_column(String(150), nullable=True)  # Изображение необязательно
     available_keys: Mapped[int] = mapped_column(default=0)
-    category_id: Mapped[int] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), nullable=False)
+    category_id: Mapped[int] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), nullable=False, index=True)
 
     category: Mapped['Category'] = relationship(back_populates="products")  # Связь с категорией
     keys: Mapped[list['Key']] = relationship(back_populates="product")  # Связь с ключами
@@ -43,23 +43,67 @@ class Product(Base):
 
 class Key(Base):
     __tablename__ = 'keys'
+    __table_args__ = (
+        Index('ix_keys_product_used', 'product_id', 'used'),  # Остатки и выборки по товару
+        # Частичный индекс только по свободным ключам (там, где диалект их поддерживает)
+        Index(
+            'ix_keys_free', 'product_id', 'id',
+            postgresql_where=text('used = 0 AND reserved_for IS NULL'),
+            sqlite_where=text('used = 0 AND reserved_for IS NULL'),
+        ),
+        # Поиск по началу названия (LIKE 'abc%'): обычный btree-индекс для LIKE не годится.
+        # В SQLite LIKE без учёта регистра, и поиск по индексу возможен только с NOCASE;
+        # в Postgres - только по индексу с varchar_pattern_ops
+        Index('ix_keys_name_nocase', text('name COLLATE NOCASE')).ddl_if(dialect='sqlite'),
+        Index('ix_keys_name_pattern', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     product_id: Mapped[int] = mapped_column(ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
-    user_id: Mapped[int] = mapped_column(ForeignKey('user.user_id', ondelete='SET NULL'), nullable=True)  # Новый внешний ключ
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.user_id', ondelete='SET NULL'), nullable=True, index=True)  # Новый внешний ключ
     name: Mapped[str] = mapped_column(String(150), nullable=False)
     description: Mapped[str] = mapped_column(Text, nullable=True)
     key_value: Mapped[str] = mapped_column(Text, nullable=True)  # Текстовый ключ, необязательно
+    key_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)  # sha256 от key_value для поиска дублей
     key_file: Mapped[str] = mapped_column(String(150), nullable=True)  # Путь к файлу, необязательно
-    expiration_date: Mapped[DateTime] = mapped_column(DateTime, nullable=True)  # Срок действия, необязательно
+    expiration_date: Mapped[DateTime] = mapped_column(DateTime, nullable=True, index=True)  # Срок действия, необязательно
     validity_period: Mapped[int] = mapped_column(nullable=True)  # Срок действия в днях, необязательно
     purchase_date: Mapped[DateTime] = mapped_column(DateTime, nullable=True)  # Дата покупки
 
     used: Mapped[int] = mapped_column(default=0)  # 0 - не использован, 1 - использован
+    pool_owner: Mapped[str] = mapped_column(String(64), nullable=True)  # Воркер, держащий ключ в пуле (database.key_pool)
+    reserved_for: Mapped[int] = mapped_column(BigInteger, nullable=True)  # Пользователь, для которого ключ отложен до оплаты
+    reserved_until: Mapped[DateTime] = mapped_column(DateTime, nullable=True)  # Когда резерв истекает
+    order_id: Mapped[int] = mapped_column(ForeignKey('orders.id', ondelete='SET NULL'), nullable=True, index=True)  # Заказ, за которым ключ закреплён или по которому выдан
 
     product: Mapped['Product'] = relationship(back_populates="keys")  # Связь с продуктом
     user: Mapped['User'] = relationship(back_populates="keys")  # Уточняем обратную связь
 
+
+# Архив проданных ключей с истёкшим сроком (или купленных давно): строки переносятся
+# из keys фоновой задачей, чтобы рабочая таблица содержала в основном живые ключи.
+# Внешних ключей нет - архив не должен меняться при удалении товара или пользователя.
+# У архива свой id: в SQLite id удалённых из keys строк может достаться новым ключам.
+class KeyArchive(Base):
+    __tablename__ = 'key_archive'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    key_id: Mapped[int] = mapped_column(nullable=True, index=True)  # id из таблицы keys на момент переноса
+    product_id: Mapped[int] = mapped_column(nullable=True)
+    product_name: Mapped[str] = mapped_column(String(150), nullable=True)  # Снимок названия товара
+    user_id: Mapped[int] = mapped_column(BigInteger, nullable=True, index=True)
+    name: Mapped[str] = mapped_column(String(150), nullable=False)
+    description: Mapped[str] = mapped_column(Text, nullable=True)
+    key_value: Mapped[str] = mapped_column(Text, nullable=True)
+    key_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
+    key_file: Mapped[str] = mapped_column(String(150), nullable=True)
+    expiration_date: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+    validity_period: Mapped[int] = mapped_column(nullable=True)
+    purchase_date: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+    used: Mapped[int] = mapped_column(default=1)
+    order_id: Mapped[int] = mapped_column(nullable=True)
+    archived: Mapped[DateTime] = mapped_column(DateTime, default=func.now())  # Когда ключ перенесён в архив
+
 class User(Base):
     __tablename__ = 'user'
 
@@ -75,6 +119,11 @@ class User(Base):
 
 class Cart(Base):
     __tablename__ = 'cart'
+    __table_args__ = (
+        # Одна строка корзины на товар; уникальный индекс, а не constraint - его можно
+        # добавить к существующей таблице и в SQLite
+        Index('uq_cart_user_product', 'user_id', 'product_id', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('user.user_id', ondelete='CASCADE'), nullable=False)
@@ -82,4 +131,51 @@ class Cart(Base):
     quantity: Mapped[int] = mapped_column(nullable=False)  # Количество не может быть NULL
 
     user: Mapped['User'] = relationship(back_populates="carts")  # Связь с пользователем
-    product: Mapped['Product'] = relationship(back_populates="carts")  # Связь с продуктом
\ No newline at end of file
+    product: Mapped['Product'] = relationship(back_populates="carts")  # Связь с продуктом
+
+
+# Статусы заказа
+ORDER_PENDING = 'pending'  # Ждёт решения администратора
+ORDER_CONFIRMED = 'confirmed'  # Оплата подтверждена, ключи выданы
+ORDER_REJECTED = 'rejected'  # Оплата отклонена
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.user_id', ondelete='CASCADE'), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), default=ORDER_PENDING)
+    total: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)  # Сумма на момент оформления
+
+    lines: Mapped[list['OrderLine']] = relationship(back_populates="order", order_by='OrderLine.id')  # Позиции заказа
+
+
+class OrderLine(Base):
+    __tablename__ = 'order_line'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    order_id: Mapped[int] = mapped_column(ForeignKey('orders.id', ondelete='CASCADE'), nullable=False)
+    product_id: Mapped[int] = mapped_column(ForeignKey('product.id', ondelete='SET NULL'), nullable=True)
+    product_name: Mapped[str] = mapped_column(String(150), nullable=False)  # Снимок названия товара
+    price: Mapped[float] = mapped_column(Numeric(5, 2), nullable=False)  # Снимок цены товара
+    quantity: Mapped[int] = mapped_column(nullable=False)
+
+    order: Mapped['Order'] = relationship(back_populates="lines")  # Связь с заказом
+
+
+class KeyNotice(Base):
+    __tablename__ = 'key_notice'
+    __table_args__ = (UniqueConstraint('key_id', 'kind'),)  # Каждое уведомление по ключу - не больше одного раза
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    key_id: Mapped[int] = mapped_column(ForeignKey('keys.id', ondelete='CASCADE'), nullable=False)
+    kind: Mapped[str] = mapped_column(String(16), nullable=False)  # Окно уведомления: '7d', '1d', 'expired'
+
+
+# Применённые миграции схемы (database.migrations)
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(200), nullable=True)
@@ -1,81 +1,876 @@
+import asyncio
 import math
+import os
+from functools import partial
 from datetime import datetime, timedelta
-from sqlalchemy import select, update, delete, func
+from sqlalchemy import Integer, select, update, delete, func, insert, case, exists, or_, and_, union_all, literal, lambda_stmt
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 
-from database.models import Banner, Cart, Category, Product, User, Key
+from database.key_pool import key_pool
+from database.models import (
+    Banner,
+    Cart,
+    Category,
+    Product,
+    User,
+    Key,
+    KeyArchive,
+    KeyNotice,
+    Order,
+    OrderLine,
+    ORDER_PENDING,
+    ORDER_CONFIRMED,
+    ORDER_REJECTED,
+)
+from database.rows import KeyRow, ProductRow
+from utils.cache import invalidate_menu, known_users
+from utils.key_import import key_hash
 
 
-############### Работа с корзиной ###############
-async def orm_get_user_carts(session: AsyncSession, user_id):
-    query = select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product))
+############### Единица работы (одна транзакция на апдейт) ###############
+# Если в session.info стоит UNIT_OF_WORK (так делает middlewares.db.DataBaseSession, кроме SQLite),
+# простые функции ниже только сбрасывают изменения в БД (flush), а коммит делается
+# один раз в конце апдейта в orm_commit_unit_of_work. Действия после коммита
+# (сброс кэшей) откладываются до него же. Оформление/подтверждение заказа,
+# резервы, импорт и архивирование коммитят сами: после них сразу идут
+# необратимые действия (выдача ключей) или они сами делят работу на транзакции.
+UNIT_OF_WORK = "unit_of_work"
+_ON_COMMIT = "on_commit"
+
+
+async def _commit(session: AsyncSession, *on_commit):
+    if session.info.get(UNIT_OF_WORK):
+        await session.flush()
+        session.info.setdefault(_ON_COMMIT, []).extend(on_commit)
+        return
+    await session.commit()
+    for callback in on_commit:
+        callback()
+
+
+async def orm_commit_unit_of_work(session: AsyncSession):
+    # Хендлер поймал ошибку ORM и завершился нормально - транзакция уже сломана,
+    # коммитить нечего: откатываем её вместе с отложенными действиями
+    if not session.is_active:
+        session.info.pop(_ON_COMMIT, None)
+        await session.rollback()
+        return
+    await session.commit()
+    for callback in session.info.pop(_ON_COMMIT, []):
+        callback()
+
+############### Кэш построения запросов ###############
+# Частые простые запросы (баннер, товары, корзина) строятся через lambda_stmt:
+# SQLAlchemy разбирает лямбду один раз на процесс и дальше берёт готовый скомпилированный
+# запрос из кэша, подставляя только параметры. Значения из замыкания становятся параметрами,
+# поэтому вычисления над ними (int(...) и т.п.) делаются до лямбды.
+
+############### Запросы для постраничного вывода (utils.paginator.QueryPaginator) ###############
+# Кэш общего количества записей по разделам каталога, сбрасывается при изменении каталога
+_count_cache: dict = {}
+
+
+def _invalidate_counts():
+    _count_cache.clear()
+
+
+async def orm_count(session: AsyncSession, query) -> int:
+    result = await session.execute(select(func.count()).select_from(query.order_by(None).subquery()))
+    return result.scalar()
+
+
+def orm_categories_query():
+    return select(Category).order_by(Category.id)
+
+
+async def orm_count_categories(session: AsyncSession) -> int:
+    cache_key = ("categories",)
+    if cache_key not in _count_cache:
+        _count_cache[cache_key] = await orm_count(session, orm_categories_query())
+    return _count_cache[cache_key]
+
+
+# Частые экраны читают только нужные колонки в лёгкие объекты из database.rows
+PRODUCT_ROW_COLUMNS = (Product.id, Product.name, Product.description, Product.price, Product.image, Product.available_keys)
+CART_ROW_COLUMNS = (Cart.id, Cart.quantity, Product.id, Product.name, Product.price, Product.image)
+KEY_ROW_COLUMNS = (
+    Key.id, Key.name, Product.name, Key.user_id, Key.used, Key.reserved_for, Key.validity_period, Key.expiration_date,
+)
+
+
+def orm_products_query(category_id):
+    # Строки для ProductRow
+    return select(*PRODUCT_ROW_COLUMNS).where(Product.category_id == int(category_id)).order_by(Product.id)
+
+
+async def orm_count_products(session: AsyncSession, category_id) -> int:
+    cache_key = ("products", int(category_id))
+    if cache_key not in _count_cache:
+        _count_cache[cache_key] = await orm_count(session, orm_products_query(category_id))
+    return _count_cache[cache_key]
+
+
+def orm_user_carts_query(user_id):
+    # Строки для CartRow
+    return (
+        select(*CART_ROW_COLUMNS)
+        .join(Product, Cart.product_id == Product.id)
+        .where(Cart.user_id == user_id)
+        .order_by(Cart.id)
+    )
+
+
+async def orm_get_cart_summary(session: AsyncSession, user_id) -> tuple[int, float]:
+    # Количество позиций и общая стоимость корзины одним запросом
+    query = lambda_stmt(lambda: (
+        select(func.count(Cart.id), func.coalesce(func.sum(Cart.quantity * Product.price), 0))
+        .join(Product, Cart.product_id == Product.id)
+        .where(Cart.user_id == user_id)
+    ))
     result = await session.execute(query)
-    return result.scalars().all()
+    count, total_price = result.one()
+    return count, total_price
+
+
+def orm_all_keys_query():
+    return select(Key).order_by(Key.id)
+
+
+def orm_free_keys_query():
+    return select(Key).where(Key.used == 0).order_by(Key.id)
+
+
+def orm_expired_keys_query():
+    current_date = datetime.utcnow()
+    return select(Key).where(
+        Key.used == 1,
+        Key.expiration_date.isnot(None),
+        Key.expiration_date < current_date
+    ).order_by(Key.id)
+
+
+############### Браузер ключей в админке ###############
+# Фильтры: товар, статус (all/free/reserved/sold), срок окончания (0 - любой,
+# N - истекает в ближайшие N дней, -1 - уже истёк) и начало названия или ID.
+# Страницы листаются по id (keyset): after - ключи после id, before - перед id,
+# поэтому любая страница - один запрос по индексу без OFFSET и без COUNT.
+KEY_STATUSES = ("all", "free", "reserved", "sold")
+
+
+def _like_prefix(prefix: str) -> str:
+    return prefix.replace("/", "//").replace("%", "/%").replace("_", "/_") + "%"
+
+
+def orm_key_browser_query(product_id=None, status="all", expiry=0, prefix=None):
+    query = select(Key)
+    if product_id:
+        query = query.where(Key.product_id == product_id)
+    if status == "free":
+        query = query.where(Key.used == 0, Key.reserved_for.is_(None))
+    elif status == "reserved":
+        query = query.where(Key.used == 0, Key.reserved_for.isnot(None))
+    elif status == "sold":
+        query = query.where(Key.used == 1)
+    now = datetime.utcnow()
+    if expiry < 0:
+        query = query.where(Key.expiration_date < now)
+    elif expiry > 0:
+        query = query.where(Key.expiration_date >= now, Key.expiration_date < now + timedelta(days=expiry))
+    if prefix:
+        # Шаблон передаётся одним параметром: только так LIKE ищет по индексу названия
+        condition = Key.name.like(_like_prefix(prefix), escape="/")
+        if prefix.isdigit():
+            condition = condition | (Key.id == int(prefix))
+        query = query.where(condition)
+    return query
+
+
+async def orm_browse_keys(session: AsyncSession, query, after: int=0, before: int=0, limit: int=10) -> tuple[list[KeyRow], bool]:
+    # Возвращает страницу ключей и признак, есть ли ещё ключи в направлении листания
+    query = query.with_only_columns(*KEY_ROW_COLUMNS).join(Product, Key.product_id == Product.id)
+    if before:
+        query = query.where(Key.id < before).order_by(Key.id.desc())
+    else:
+        query = query.where(Key.id > after).order_by(Key.id)
+    query = query.limit(limit + 1)
+    keys = [KeyRow(*row) for row in await session.execute(query)]
+    has_more = len(keys) > limit
+    keys = keys[:limit]
+    if before:
+        keys.reverse()
+    return keys, has_more
+
+
+############### Массовые операции над выборкой браузера ключей ###############
+# Каждая операция - один UPDATE/DELETE по условию выборки (фильтры orm_key_browser_query)
+# и пересчёт остатка затронутых товаров.
+BULK_DELETE = "delete"    # удалить свободные ключи
+BULK_EXTEND = "extend"    # продлить срок ключей на N дней
+BULK_MOVE = "move"        # перенести свободные ключи в товар N
+
+
+def orm_bulk_keys_query(action: str, **filters):
+    # Ключи выборки, которые затронет операция
+    query = orm_key_browser_query(**filters)
+    if action in (BULK_DELETE, BULK_MOVE):
+        query = query.where(Key.used == 0, Key.reserved_for.is_(None))
+    elif action == BULK_EXTEND:
+        query = query.where(Key.expiration_date.isnot(None))
+    return query
 
 
+async def orm_bulk_keys(session: AsyncSession, action: str, value: int=None, **filters) -> int:
+    condition = orm_bulk_keys_query(action, **filters).whereclause
+    if action == BULK_DELETE:
+        stmt = delete(Key)
+    elif action == BULK_EXTEND:
+        if _dialect_name(session) == "sqlite":
+            new_expiration = func.datetime(Key.expiration_date, f"+{int(value)} days")
+        else:
+            new_expiration = Key.expiration_date + timedelta(days=value)
+        stmt = update(Key).values(
+            expiration_date=new_expiration,
+            validity_period=func.coalesce(Key.validity_period, 0) + value,
+        )
+    elif action == BULK_MOVE:
+        # Ключ уходит из пула старого товара; устаревшие id пула отбросит _claim_keys
+        stmt = update(Key).values(product_id=value, pool_owner=None)
+    else:
+        raise ValueError(f"Неизвестная операция: {action}")
+    if condition is not None:
+        stmt = stmt.where(condition)
+
+    result = await session.execute(stmt.execution_options(synchronize_session=False))
+    if action in (BULK_DELETE, BULK_MOVE):
+        # Без фильтра по товару операция могла затронуть любой товар
+        product_id = filters.get("product_id")
+        product_ids = None if not product_id else [product_id] + ([value] if action == BULK_MOVE else [])
+        await _recount_stock(session, product_ids)
+        await _commit(session, partial(invalidate_menu, level=2))
+    else:
+        await _commit(session)
+    return result.rowcount
+
+
+async def orm_get_product_names(session: AsyncSession) -> list[tuple[int, str]]:
+    query = select(Product.id, Product.name).order_by(Product.name)
+    return [tuple(row) for row in await session.execute(query)]
+
+############### Работа с корзиной ###############
 ############### Оплата ###############
-async def orm_process_order_from_cart(session: AsyncSession, user_id: int, product_id: int) -> list[Key]:
-    query = select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
+# В SQLite нет SELECT ... FOR UPDATE, поэтому подтверждение заказов внутри процесса
+# выполняется строго по очереди (запись в SQLite и так сериализуется на уровне файла)
+_sqlite_checkout_lock = asyncio.Lock()
+
+
+def _dialect_name(session: AsyncSession) -> str:
+    return session.bind.dialect.name
+
+
+# insert с поддержкой ON CONFLICT для диалектов, где он есть
+_UPSERT_INSERTS = {
+    "postgresql": postgresql_insert,
+    "sqlite": sqlite_insert,
+}
+
+
+# Выдаёт ключи заказа по позициям [(product_id, количество, название товара), ...] без commit.
+# Сначала берутся ключи, закреплённые за заказом, недостающие - из пула;
+# id ключей, взятых из пула, складываются в claimed_ids, чтобы при откате вернуть их в пул
+async def _sell_keys(session: AsyncSession, order_id: int, user_id: int, items, claimed_ids: dict[int, list[int]]) -> dict[int, list[Key]]:
+    claimed: dict[int, list[Key]] = {}
+    stock_delta = {}
+    # Сначала подбираем ключи по всем позициям, и только потом пишем в БД
+    for product_id, quantity, name in items:
+        query = (
+            select(Key)
+            .where(Key.order_id == order_id, Key.product_id == product_id, Key.used == 0)
+            .order_by(Key.id)
+            .limit(quantity)
+            .with_for_update()
+        )
+        keys = list((await session.execute(query)).scalars().all())
+        extra_keys = await _claim_keys(session, product_id, quantity - len(keys), claimed_ids)
+        # Отложенные ключи уже вычтены из остатка, ключи из пула - ещё нет
+        stock_delta[product_id] = -len(extra_keys)
+        keys.extend(extra_keys)
+        claimed[product_id] = keys
+        if len(keys) < quantity:
+            raise ValueError(
+                f"Не хватает ключей для товара {name} "
+                f"(нужно {quantity}, доступно {len(keys)})!"
+            )
+
+    current_date = datetime.utcnow()
+    for product_id, keys in claimed.items():
+        for key in keys:
+            key.user_id = user_id
+            key.order_id = order_id
+            key.used = 1
+            key.pool_owner = None
+            key.reserved_for = None
+            key.reserved_until = None
+            key.purchase_date = current_date
+            if key.validity_period:
+                key.expiration_date = current_date + timedelta(days=key.validity_period)
+        await _change_stock(session, product_id, stock_delta[product_id])
+
+    # Ключи заказа сверх выданного (если такие остались) возвращаем в продажу
+    await _release_order_reservations(session, order_id)
+    return claimed
+
+
+async def _claim_keys(session: AsyncSession, product_id: int, quantity: int, claimed_ids: dict[int, list[int]]) -> list[Key]:
+    # id из пула могли устареть (ключ удалили, перенесли в другой товар или отложили),
+    # такие просто отбрасываем и добираем недостающие. В claimed_ids попадают только
+    # ключи из пула: при откате их возвращают в пул, а ключи, добранные из БД напрямую,
+    # за воркером не числятся и достанутся пулу обычным пополнением
+    keys = []
+    pool_ids = claimed_ids.setdefault(product_id, [])
+    while len(keys) < quantity:
+        ids = await key_pool.claim(product_id, quantity - len(keys))
+        if not ids:
+            break
+        query = (
+            select(Key)
+            .where(
+                Key.id.in_(ids),
+                Key.product_id == product_id,
+                Key.used == 0,
+                Key.reserved_for.is_(None),
+            )
+            .with_for_update()
+        )
+        result = await session.execute(query)
+        pool_keys = result.scalars().all()
+        pool_ids.extend(key.id for key in pool_keys)
+        keys.extend(pool_keys)
+    if len(keys) < quantity:
+        # Пул пуст или не видит ключей, освобождённых в этой же транзакции - добираем из БД напрямую
+        query = (
+            select(Key)
+            .where(
+                Key.product_id == product_id,
+                Key.used == 0,
+                Key.reserved_for.is_(None),
+                Key.id.not_in([key.id for key in keys]),
+            )
+            .order_by(Key.id)
+            .limit(quantity - len(keys))
+            .with_for_update(skip_locked=True)
+        )
+        result = await session.execute(query)
+        keys.extend(result.scalars().all())
+    return keys
+
+############### Заказы ###############
+# Заказ фиксирует состав корзины и цены в момент отправки скриншота оплаты.
+# Подтверждение и отклонение переводят заказ из статуса pending ровно один раз,
+# поэтому повторное нажатие кнопки ничего не делает и не трогает ключи
+async def orm_create_order(session: AsyncSession, user_id: int) -> Order | None:
+    query = (
+        select(Cart)
+        .where(Cart.user_id == user_id)
+        .options(joinedload(Cart.product, innerjoin=True))
+        .order_by(Cart.product_id)
+    )
+    carts = (await session.execute(query)).scalars().all()
+    if not carts:
+        return None
+
+    order = Order(
+        user_id=user_id,
+        status=ORDER_PENDING,
+        total=sum(cart.product.price * cart.quantity for cart in carts),
+        lines=[
+            OrderLine(
+                product_id=cart.product_id,
+                product_name=cart.product.name,
+                price=cart.product.price,
+                quantity=cart.quantity,
+            )
+            for cart in carts
+        ],
+    )
+    session.add(order)
+    await session.flush()
+    # Ключи, отложенные пользователем по корзине, закрепляются за заказом: такой резерв
+    # не истекает и не снимается новым заказом, а освобождается только при отклонении
+    for line in order.lines:
+        query = (
+            select(Key.id)
+            .where(
+                Key.reserved_for == user_id,
+                Key.order_id.is_(None),
+                Key.product_id == line.product_id,
+                Key.used == 0,
+            )
+            .order_by(Key.id)
+            .limit(line.quantity)
+            .with_for_update()
+        )
+        key_ids = (await session.execute(query)).scalars().all()
+        if key_ids:
+            await session.execute(
+                update(Key)
+                .where(Key.id.in_(key_ids))
+                .values(order_id=order.id, reserved_until=None)
+                .execution_options(synchronize_session=False)
+            )
+    # Резервы сверх заказа (корзину уменьшили после "Заказать") возвращаем в продажу
+    await _release_user_reservations(session, user_id)
+    await session.execute(delete(Cart).where(Cart.user_id == user_id))
+    await session.commit()
+    invalidate_menu(level=2)
+    return order
+
+
+async def orm_get_order(session: AsyncSession, order_id: int) -> Order | None:
+    query = select(Order).where(Order.id == order_id).options(selectinload(Order.lines))
     result = await session.execute(query)
-    cart_item = result.scalar()
+    return result.scalar()
 
-    if not cart_item:
-        raise ValueError("Товар не найден в корзине!")
 
-    quantity = cart_item.quantity
-    query = select(Key).where(Key.product_id == product_id, Key.used == 0).limit(quantity)
+# Подтверждение заказа: выдаёт ключи по всем позициям одной транзакцией.
+# Возвращает (заказ, [(позиция, ключ), ...]) или None, если заказ уже обработан
+async def orm_confirm_order(session: AsyncSession, order_id: int) -> tuple[Order, list[tuple[OrderLine, Key]]] | None:
+    if _dialect_name(session) == "sqlite":
+        async with _sqlite_checkout_lock:
+            return await _confirm_order(session, order_id)
+    return await _confirm_order(session, order_id)
+
+
+async def _confirm_order(session: AsyncSession, order_id: int):
+    claimed_ids: dict[int, list[int]] = {}
+    try:
+        if not await _switch_order_status(session, order_id, ORDER_CONFIRMED):
+            await session.rollback()
+            return None
+        order = await orm_get_order(session, order_id)
+        items = [(line.product_id, line.quantity, line.product_name) for line in order.lines]
+        sold = await _sell_keys(session, order.id, order.user_id, items, claimed_ids)
+        all_keys = [(line, key) for line in order.lines for key in sold[line.product_id]]
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        for product_id, ids in claimed_ids.items():
+            key_pool.release(product_id, ids)
+        raise
+    invalidate_menu(level=2)
+    return order, all_keys
+
+
+# Отклонение заказа: возвращает в продажу ключи, закреплённые за заказом. None - если заказ уже обработан
+async def orm_reject_order(session: AsyncSession, order_id: int) -> Order | None:
+    if not await _switch_order_status(session, order_id, ORDER_REJECTED):
+        await session.rollback()
+        return None
+    order = await orm_get_order(session, order_id)
+    await _release_order_reservations(session, order_id)
+    await session.commit()
+    invalidate_menu(level=2)
+    return order
+
+
+async def _switch_order_status(session: AsyncSession, order_id: int, status: str) -> bool:
+    # Условный UPDATE: из pending заказ выходит только один раз, параллельный дубль получит 0 строк
+    query = (
+        update(Order)
+        .where(Order.id == order_id, Order.status == ORDER_PENDING)
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    )
     result = await session.execute(query)
-    keys = result.scalars().all()
+    return result.rowcount == 1
+
+############### Резервирование ключей на время оплаты ###############
+# Резерв по корзине (reserved_for) держится RESERVATION_TTL, пока пользователь оплачивает.
+# При отправке скриншота (orm_create_order) отложенные ключи закрепляются за заказом
+# (Key.order_id): такие ключи ждут решения администратора без срока и освобождаются
+# только при отклонении этого заказа
+RESERVATION_TTL = timedelta(minutes=int(os.getenv("RESERVATION_TTL_MINUTES", 30)))
+
+
+# Откладывает ключи по всей корзине пользователя. Возвращает список нехваток
+# [(название товара, нужно, доступно), ...]; если он не пуст, ничего не откладывается
+async def orm_reserve_cart(session: AsyncSession, user_id: int) -> list[tuple[str, int, int]]:
+    claimed_ids: dict[int, list[int]] = {}
+    try:
+        query = (
+            select(Cart)
+            .where(Cart.user_id == user_id)
+            .options(joinedload(Cart.product, innerjoin=True))
+            .order_by(Cart.product_id)
+        )
+        carts = (await session.execute(query)).scalars().all()
+
+        # Как и при покупке: сначала подбираем ключи (уже отложенные для пользователя
+        # при прошлом заказе плюс недостающие из пула), и только потом пишем в БД
+        shortages = []
+        reserved = {}
+        for cart in carts:
+            query = (
+                select(Key)
+                .where(
+                    Key.reserved_for == user_id,
+                    Key.order_id.is_(None),
+                    Key.product_id == cart.product_id,
+                    Key.used == 0,
+                )
+                .order_by(Key.id)
+                .limit(cart.quantity)
+                .with_for_update()
+            )
+            own_keys = list((await session.execute(query)).scalars().all())
+            extra_keys = await _claim_keys(session, cart.product_id, cart.quantity - len(own_keys), claimed_ids)
+            if len(own_keys) + len(extra_keys) < cart.quantity:
+                shortages.append((cart.product.name, cart.quantity, len(own_keys) + len(extra_keys)))
+            reserved[cart.product_id] = (own_keys, extra_keys)
+
+        if shortages:
+            await session.rollback()
+            for product_id, ids in claimed_ids.items():
+                key_pool.release(product_id, ids)
+            return shortages
+
+        reserved_until = datetime.utcnow() + RESERVATION_TTL
+        kept_ids = []
+        for product_id, (own_keys, extra_keys) in reserved.items():
+            for key in own_keys + extra_keys:
+                key.pool_owner = None
+                key.reserved_for = user_id
+                key.reserved_until = reserved_until
+                kept_ids.append(key.id)
+            await _change_stock(session, product_id, -len(extra_keys))
+
+        # Прошлые резервы по корзине, которые больше не нужны, возвращаем в продажу
+        await _release_user_reservations(session, user_id, keep_ids=kept_ids)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        for product_id, ids in claimed_ids.items():
+            key_pool.release(product_id, ids)
+        raise
+    invalidate_menu(level=2)
+    return []
 
-    if len(keys) < quantity:
-        raise ValueError(f"Не хватает ключей для товара (нужно {quantity}, доступно {len(keys)})!")
 
+async def orm_release_reservations(session: AsyncSession, user_id: int):
+    await _release_user_reservations(session, user_id)
+    await _commit(session, partial(invalidate_menu, level=2))
+
+
+async def _release_user_reservations(session: AsyncSession, user_id: int, keep_ids=()):
+    # Только резервы по корзине; ключи, закреплённые за заказами, не трогаем
+    await _release_keys(session, Key.reserved_for == user_id, Key.order_id.is_(None), Key.used == 0, Key.id.not_in(keep_ids))
+
+
+async def _release_order_reservations(session: AsyncSession, order_id: int):
+    await _release_keys(session, Key.order_id == order_id, Key.used == 0)
+
+
+async def _release_keys(session: AsyncSession, *condition):
+    query = select(Key.product_id).where(*condition).distinct()
+    product_ids = (await session.execute(query)).scalars().all()
+    if not product_ids:
+        return
+    await session.execute(
+        update(Key)
+        .where(*condition)
+        .values(reserved_for=None, reserved_until=None, order_id=None)
+    )
+    await _recount_stock(session, product_ids)
+
+
+# Снимает все истёкшие резервы по корзинам (ключи заказов в ожидании срока не имеют):
+# ключи освобождаются одним UPDATE на весь проход,
+# затем пересчитываются остатки затронутых товаров. Возвращает число освобождённых ключей
+async def orm_release_expired_reservations(session: AsyncSession) -> int:
     current_date = datetime.utcnow()
-    for key in keys:
-        key.user_id = user_id
-        key.used = 1
-        key.purchase_date = current_date
-        if key.validity_period:
-            key.expiration_date = current_date + timedelta(days=key.validity_period)
-
-    await session.delete(cart_item)
+    expired = (
+        Key.reserved_until.isnot(None),
+        Key.reserved_until < current_date,
+        Key.order_id.is_(None),
+        Key.used == 0,
+    )
+    query = select(Key.product_id).where(*expired).distinct()
+    product_ids = (await session.execute(query)).scalars().all()
+    if not product_ids:
+        return 0
+    result = await session.execute(
+        update(Key)
+        .where(*expired)
+        .values(reserved_for=None, reserved_until=None)
+        .execution_options(synchronize_session=False)
+    )
+    await _recount_stock(session, product_ids)
     await session.commit()
-    return keys
+    invalidate_menu(level=2)
+    return result.rowcount
 
 async def orm_add_key(session: AsyncSession, product_id: int, name: str, key_value: str = None, key_file: str = None, validity_period: int = None):
     key = Key(
         product_id=product_id,
         name=name,
         key_value=key_value,
+        key_hash=key_hash(key_value) if key_value else None,
         key_file=key_file,
         validity_period=validity_period  # Добавляем параметр в создание объекта
     )
     session.add(key)
-    await session.commit()
+    await _change_stock(session, product_id, 1)
+    await _commit(session, partial(invalidate_menu, level=2))
+
+############### Массовый импорт ключей ###############
+# Колонки, которые заполняет импорт (для COPY на Postgres нужен явный список)
+IMPORT_COLUMNS = ("product_id", "name", "key_value", "key_hash", "validity_period", "used", "created", "updated")
+
+
+# Импорт ключей товара пачками по batch_size строк. Дубли (по key_hash среди ключей
+# и архива, в том числе внутри самого файла) пропускаются. Всё выполняется одной транзакцией,
+# счётчик остатка меняется один раз в конце. progress(added, duplicates) вызывается
+# после каждой пачки. Возвращает (добавлено, дублей).
+async def orm_import_keys(
+    session: AsyncSession,
+    product_id: int,
+    rows,
+    validity_period: int = None,
+    batch_size: int = 1000,
+    progress=None,
+) -> tuple[int, int]:
+    seen = set()
+    added = duplicates = 0
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted = await _import_batch(session, product_id, batch, validity_period, seen)
+                added += inserted
+                duplicates += len(batch) - inserted
+                batch = []
+                if progress:
+                    await progress(added, duplicates)
+        if batch:
+            inserted = await _import_batch(session, product_id, batch, validity_period, seen)
+            added += inserted
+            duplicates += len(batch) - inserted
+        await _change_stock(session, product_id, added)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    invalidate_menu(level=2)
+    return added, duplicates
+
+
+async def _import_batch(session: AsyncSession, product_id: int, batch: list[dict], validity_period, seen: set) -> int:
+    hashes = {}
+    for row in batch:
+        value_hash = key_hash(row["key_value"])
+        if value_hash not in seen:
+            hashes.setdefault(value_hash, row)
+    if hashes:
+        query = union_all(
+            select(Key.key_hash).where(Key.key_hash.in_(list(hashes))),
+            select(KeyArchive.key_hash).where(KeyArchive.key_hash.in_(list(hashes))),
+        )
+        existing = set((await session.execute(query)).scalars())
+        seen.update(hashes)
+        for value_hash in existing:
+            hashes.pop(value_hash)
+    if not hashes:
+        return 0
+
+    now = datetime.utcnow()
+    records = [
+        {
+            "product_id": product_id,
+            "name": row["name"],
+            "key_value": row["key_value"],
+            "key_hash": value_hash,
+            "validity_period": row["validity_period"] or validity_period,
+            "used": 0,
+            "created": now,
+            "updated": now,
+        }
+        for value_hash, row in hashes.items()
+    ]
+    if _dialect_name(session) == "postgresql":
+        # COPY - самый быстрый способ вставки пачки строк в Postgres
+        connection = await session.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            Key.__tablename__,
+            records=[tuple(record[column] for column in IMPORT_COLUMNS) for record in records],
+            columns=IMPORT_COLUMNS,
+        )
+    else:
+        # executemany одним запросом на пачку
+        await session.execute(insert(Key), records)
+    return len(records)
+
+############### Уведомления об окончании срока ключей ###############
+# Окна уведомлений в днях до окончания срока (по убыванию) и сколько дней после
+# окончания ещё присылать уведомление "срок истёк" (чтобы не писать по давно истёкшим)
+EXPIRY_NOTICE_WINDOWS = tuple(sorted(
+    (int(days) for days in os.getenv("EXPIRY_NOTICE_WINDOWS", "7,1").split(",") if days.strip()),
+    reverse=True,
+))
+EXPIRY_NOTICE_LOOKBACK = timedelta(days=int(os.getenv("EXPIRY_NOTICE_LOOKBACK_DAYS", 3)))
+NOTICE_EXPIRED = "expired"
+
+
+# Проданные ключи, по которым пора отправить уведомление и оно ещё не отправлялось.
+# Окна не пересекаются: ключ попадает в самое узкое подходящее окно. Один запрос
+# по индексу на expiration_date; limit ограничивает пачку за один запуск.
+async def orm_get_due_expiry_notices(session: AsyncSession, limit: int=200):
+    now = datetime.utcnow()
+    kind = case(
+        (Key.expiration_date <= now, NOTICE_EXPIRED),
+        *(
+            (Key.expiration_date <= now + timedelta(days=days), f"{days}d")
+            for days in reversed(EXPIRY_NOTICE_WINDOWS)
+        ),
+    )
+    sent = exists().where(KeyNotice.key_id == Key.id, KeyNotice.kind == kind)
+    query = (
+        select(Key.id, Key.user_id, Key.name, Product.name, Key.expiration_date, kind.label("kind"))
+        .join_from(Key, Product)
+        .where(
+            Key.used == 1,
+            Key.user_id.isnot(None),
+            Key.expiration_date > now - EXPIRY_NOTICE_LOOKBACK,
+            Key.expiration_date <= now + timedelta(days=max(EXPIRY_NOTICE_WINDOWS, default=0)),
+            ~sent,
+        )
+        .order_by(Key.expiration_date)
+        .limit(limit)
+    )
+    return (await session.execute(query)).all()
+
+
+async def orm_mark_notices_sent(session: AsyncSession, notices: list[tuple[int, str]]):
+    session.add_all(KeyNotice(key_id=key_id, kind=kind) for key_id, kind in notices)
+    await _commit(session)
+
+############### Архивирование ключей ###############
+# Проданный ключ уходит в key_archive через KEY_ARCHIVE_AFTER_DAYS после окончания срока,
+# бессрочный - через KEY_RETENTION_DAYS после покупки
+KEY_ARCHIVE_AFTER = timedelta(days=int(os.getenv("KEY_ARCHIVE_AFTER_DAYS", 30)))
+KEY_RETENTION = timedelta(days=int(os.getenv("KEY_RETENTION_DAYS", 365)))
+
+ARCHIVE_COLUMNS = (
+    "key_id", "product_id", "product_name", "user_id", "name", "description", "key_value", "key_hash",
+    "key_file", "expiration_date", "validity_period", "purchase_date", "used", "order_id",
+    "archived", "created", "updated",
+)
+
+
+# Переносит ключи пачками по batch_size, каждая пачка - отдельная короткая транзакция
+# (INSERT ... SELECT + DELETE по id), чтобы не держать блокировку на keys.
+# Не больше max_batches пачек за запуск. Возвращает число перенесённых ключей.
+async def orm_archive_keys(session: AsyncSession, batch_size: int=500, max_batches: int=20) -> int:
+    now = datetime.utcnow()
+    archivable = and_(
+        Key.used == 1,
+        or_(
+            Key.expiration_date < now - KEY_ARCHIVE_AFTER,
+            and_(Key.expiration_date.is_(None), Key.purchase_date < now - KEY_RETENTION),
+        ),
+    )
+    archived = 0
+    for _ in range(max_batches):
+        ids = (await session.execute(select(Key.id).where(archivable).order_by(Key.id).limit(batch_size))).scalars().all()
+        if not ids:
+            break
+        rows = (
+            select(
+                Key.id, Key.product_id, Product.name, Key.user_id, Key.name, Key.description, Key.key_value,
+                Key.key_hash, Key.key_file, Key.expiration_date, Key.validity_period, Key.purchase_date,
+                Key.used, Key.order_id, literal(now), Key.created, Key.updated,
+            )
+            # Ключи удалённого товара (в SQLite каскад не срабатывает) тоже архивируются
+            .outerjoin_from(Key, Product)
+            .where(Key.id.in_(ids))
+        )
+        await session.execute(insert(KeyArchive).from_select(ARCHIVE_COLUMNS, rows))
+        # SQLite без PRAGMA foreign_keys не выполняет ON DELETE CASCADE - чистим явно
+        await session.execute(delete(KeyNotice).where(KeyNotice.key_id.in_(ids)))
+        await session.execute(delete(Key).where(Key.id.in_(ids)).execution_options(synchronize_session=False))
+        await session.commit()
+        archived += len(ids)
+        if len(ids) < batch_size:
+            break
+    return archived
 
 ############### Редактирование/удаление ключей ###############
 async def orm_delete_key(session: AsyncSession, key_id: int):
+    query = select(Key.product_id, Key.used, Key.reserved_for).where(Key.id == key_id)
+    result = await session.execute(query)
+    key = result.first()
+    if not key:
+        return
     stmt = delete(Key).where(Key.id == key_id)
     await session.execute(stmt)
-    await session.commit()  # Добавляем фиксацию изменений
+    if not key.used and key.reserved_for is None:
+        await _change_stock(session, key.product_id, -1)
+    await _commit(session, partial(invalidate_menu, level=2))  # Добавляем фиксацию изменений
 
 async def orm_update_key(session: AsyncSession, key_id: int, data: dict):
     query = select(Key).where(Key.id == key_id)
     result = await session.execute(query)
     key = result.scalar_one()
+    old_product_id, old_free = key.product_id, _is_free(key)
     for field, value in data.items():
         setattr(key, field, value)
-    await session.commit() 
+    if "key_value" in data:
+        key.key_hash = key_hash(key.key_value) if key.key_value else None
+    # Ключ мог перейти в другой товар или поменять статус - переносим его в счётчиках
+    if (old_product_id, old_free) != (key.product_id, _is_free(key)):
+        if old_free:
+            await _change_stock(session, old_product_id, -1)
+        if _is_free(key):
+            await _change_stock(session, key.product_id, 1)
+    await _commit(session, partial(invalidate_menu, level=2))
+
+############### Остаток ключей (счётчик Product.available_keys) ###############
+# Счётчик свободных (не проданных и не отложенных) ключей меняется в той же транзакции,
+# что и сами ключи, поэтому чтение остатка - это чтение одной колонки без подсчёта по таблице keys
+def _is_free(key: Key) -> bool:
+    return not key.used and key.reserved_for is None
+
 
-############### Выборка остатка действующих ключей ###############
-async def orm_get_available_keys_count(session: AsyncSession, product_id: int) -> int:
-    query = select(func.count(Key.id)).where(
-        Key.product_id == product_id,
-        Key.used == 0
+async def _change_stock(session: AsyncSession, product_id: int, delta: int):
+    if not delta:
+        return
+    query = (
+        update(Product)
+        .where(Product.id == product_id)
+        .values(available_keys=Product.available_keys + delta)
     )
-    result = await session.execute(query)
-    return result.scalar()
+    await session.execute(query)
+
+
+# Сверка счётчиков с таблицей keys (для всех товаров или только для указанных)
+async def orm_recount_available_keys(session: AsyncSession, product_ids=None):
+    await _recount_stock(session, product_ids)
+    await _commit(session, partial(invalidate_menu, level=2))
+
+
+async def _recount_stock(session: AsyncSession, product_ids=None):
+    free_keys = (
+        select(func.count(Key.id))
+        .where(Key.product_id == Product.id, Key.used == 0, Key.reserved_for.is_(None))
+        .scalar_subquery()
+    )
+    query = update(Product).values(available_keys=free_keys)
+    if product_ids is not None:
+        query = query.where(Product.id.in_(product_ids))
+    await session.execute(query.execution_options(synchronize_session=False))
 
 ############### Работа с баннерами (информационными страницами) ###############
 
@@ -87,17 +882,17 @@ async def orm_add_banner_description(session: AsyncSession, data: dict):
     if result.first():
         return
     session.add_all([Banner(name=name, description=description) for name, description in data.items()]) 
-    await session.commit()
+    await _commit(session)
 
 
 async def orm_change_banner_image(session: AsyncSession, name: str, image: str):
     query = update(Banner).where(Banner.name == name).values(image=image)
     await session.execute(query)
-    await session.commit()
+    await _commit(session, invalidate_menu)
 
 
 async def orm_get_banner(session: AsyncSession, page: str):
-    query = select(Banner).where(Banner.name == page)
+    query = lambda_stmt(lambda: select(Banner).where(Banner.name == page))
     result = await session.execute(query)
     return result.scalar()
 
@@ -121,7 +916,7 @@ async def orm_create_categories(session: AsyncSession, categories: list):
     if result.first():
         return
     session.add_all([Category(name=name) for name in categories]) 
-    await session.commit()
+    await _commit(session, _invalidate_counts, invalidate_menu)
 
 ############ Админка: добавить/изменить/удалить товар ########################
 
@@ -134,17 +929,18 @@ async def orm_add_product(session: AsyncSession, data: dict):
         category_id=int(data["category"]),
     )
     session.add(obj)
-    await session.commit()
+    await _commit(session, _invalidate_counts, partial(invalidate_menu, level=2))
 
 
-async def orm_get_products(session: AsyncSession, category_id):
-    query = select(Product).where(Product.category_id == int(category_id))
+async def orm_get_products(session: AsyncSession, category_id) -> list[ProductRow]:
+    category_id = int(category_id)
+    query = lambda_stmt(lambda: select(*PRODUCT_ROW_COLUMNS).where(Product.category_id == category_id))
     result = await session.execute(query)
-    return result.scalars().all()
+    return [ProductRow(*row) for row in result]
 
 
 async def orm_get_product(session: AsyncSession, product_id: int):
-    query = select(Product).where(Product.id == product_id)
+    query = lambda_stmt(lambda: select(Product).where(Product.id == product_id))
     result = await session.execute(query)
     return result.scalar()
 
@@ -162,16 +958,19 @@ async def orm_update_product(session: AsyncSession, product_id: int, data):
         )
     )
     await session.execute(query)
-    await session.commit()
+    await _commit(session, _invalidate_counts, partial(invalidate_menu, level=2))
 
 
 async def orm_delete_product(session: AsyncSession, product_id: int):
     query = delete(Product).where(Product.id == product_id)
     await session.execute(query)
-    await session.commit()
+    await _commit(session, _invalidate_counts, partial(invalidate_menu, level=2))
 
 ##################### Добавляем юзера в БД #####################################
 
+# Регистрация пользователя одним запросом INSERT ... ON CONFLICT: для нового пользователя
+# добавляется строка, для уже известного обновляются имя и фамилия (телефон - если передан).
+# Пользователи из known_users (уже записанные этим процессом) в БД не ходят вовсе
 async def orm_add_user(
     session: AsyncSession,
     user_id: int,
@@ -179,33 +978,61 @@ async def orm_add_user(
     last_name: str | None = None,
     phone: str | None = None,
 ):
-    query = select(User).where(User.user_id == user_id)
-    result = await session.execute(query)
-    if result.first() is None:
-        session.add(
-            User(user_id=user_id, first_name=first_name, last_name=last_name, phone=phone)
-        )
-        await session.commit()
+    if known_users.get(user_id):
+        return
+    dialect = _dialect_name(session)
+    if dialect not in _UPSERT_INSERTS:
+        query = select(User).where(User.user_id == user_id)
+        result = await session.execute(query)
+        if result.first() is None:
+            session.add(
+                User(user_id=user_id, first_name=first_name, last_name=last_name, phone=phone)
+            )
+        await _commit(session, partial(known_users.set, user_id, True))
+        return
+    query = _UPSERT_INSERTS[dialect](User).values(
+        user_id=user_id, first_name=first_name, last_name=last_name, phone=phone,
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={
+            "first_name": query.excluded.first_name,
+            "last_name": query.excluded.last_name,
+            "phone": func.coalesce(query.excluded.phone, User.phone),
+            "updated": func.now(),
+        },
+    )
+    await session.execute(query)
+    await _commit(session, partial(known_users.set, user_id, True))
 
 
 ######################## Работа с корзинами #######################################
 
+# Одна строка корзины на товар (уникальный индекс uq_cart_user_product): добавление -
+# один INSERT ... ON CONFLICT DO UPDATE, поэтому двойное нажатие "Купить" из двух
+# апдейтов сразу увеличивает количество, а не падает на уникальном индексе
 async def orm_add_to_cart(session: AsyncSession, user_id: int, product_id: int):
-    query = select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
-    cart = await session.execute(query)
-    cart = cart.scalar()
-    if cart:
-        cart.quantity += 1
-        await session.commit()
-        return cart
-    else:
-        session.add(Cart(user_id=user_id, product_id=product_id, quantity=1))
-        await session.commit()
-
+    dialect = _dialect_name(session)
+    if dialect not in _UPSERT_INSERTS:
+        query = select(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
+        cart = (await session.execute(query)).scalar()
+        if cart:
+            cart.quantity += 1
+        else:
+            session.add(Cart(user_id=user_id, product_id=product_id, quantity=1))
+        await _commit(session)
+        return
+    query = _UPSERT_INSERTS[dialect](Cart).values(user_id=user_id, product_id=product_id, quantity=1)
+    query = query.on_conflict_do_update(
+        index_elements=[Cart.user_id, Cart.product_id],
+        set_={"quantity": Cart.quantity + 1, "updated": func.now()},
+    )
+    await session.execute(query)
+    await _commit(session)
 
 
 async def orm_get_user_carts(session: AsyncSession, user_id):
-    query = select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product))
+    query = lambda_stmt(lambda: select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product)))
     result = await session.execute(query)
     return result.scalars().all()
 
@@ -213,7 +1040,7 @@ async def orm_get_user_carts(session: AsyncSession, user_id):
 async def orm_delete_from_cart(session: AsyncSession, user_id: int, product_id: int):
     query = delete(Cart).where(Cart.user_id == user_id, Cart.product_id == product_id)
     await session.execute(query)
-    await session.commit()
+    await _commit(session)
 
 
 async def orm_reduce_product_in_cart(session: AsyncSession, user_id: int, product_id: int):
@@ -225,32 +1052,83 @@ async def orm_reduce_product_in_cart(session: AsyncSession, user_id: int, produc
         return
     if cart.quantity > 1:
         cart.quantity -= 1
-        await session.commit()
+        await _commit(session)
         return True
     else:
         await orm_delete_from_cart(session, user_id, product_id)
-        await session.commit()
         return False
 
-# Все ключи
-async def orm_get_all_keys(session: AsyncSession):
-    query = select(Key).options(joinedload(Key.product))
-    result = await session.execute(query)
-    return result.scalars().all()
+############### Выгрузка ключей и продаж ###############
+# Строки читаются курсором пачками по EXPORT_BATCH_SIZE и сразу отдаются вызывающему,
+# поэтому память не зависит от размера таблицы. Выбираются только нужные колонки,
+# без ORM-объектов и identity map.
+EXPORT_BATCH_SIZE = 1000
 
-# Свободные ключи
-async def orm_get_free_keys(session: AsyncSession):
-    query = select(Key).where(Key.used == 0).options(joinedload(Key.product))
-    result = await session.execute(query)
-    return result.scalars().all()
+KEY_EXPORT_QUERIES = {
+    "all": orm_all_keys_query,
+    "free": orm_free_keys_query,
+    "expired": orm_expired_keys_query,
+}
 
-# Просроченные ключи
-async def orm_get_expired_keys(session: AsyncSession):
-    current_date = datetime.utcnow()
-    query = select(Key).where(
-        Key.used == 1,
-        Key.expiration_date.isnot(None),
-        Key.expiration_date < current_date
-    ).options(joinedload(Key.product))
-    result = await session.execute(query)
-    return result.scalars().all()
+# id - id ключа в keys; у архивных строк ещё archive_id (SQLite может выдать id
+# удалённого в архив ключа новому ключу, и тогда одинаковый id будет у двух строк)
+KEY_EXPORT_COLUMNS = (
+    "id", "product", "name", "key_value", "key_file", "used", "user_id",
+    "purchase_date", "validity_period", "expiration_date", "order_id", "archive_id",
+)
+
+SALES_EXPORT_COLUMNS = (
+    "order_id", "created", "user_id", "status", "product", "price", "quantity",
+)
+
+
+# Выгрузка проданных ключей читает и рабочую таблицу, и архив (key_archive)
+async def orm_stream_keys(session: AsyncSession, kind: str):
+    hot = (
+        KEY_EXPORT_QUERIES[kind]()
+        .with_only_columns(
+            Key.id, Product.name, Key.name, Key.key_value, Key.key_file, Key.used, Key.user_id,
+            Key.purchase_date, Key.validity_period, Key.expiration_date, Key.order_id,
+            literal(None, Integer),
+        )
+        .outerjoin_from(Key, Product)
+        .order_by(None)
+    )
+    archive = _archived_keys_query(kind)
+    if archive is None:
+        query = hot.order_by(Key.id)
+    else:
+        history = union_all(hot, archive).subquery()
+        query = select(history).order_by(history.c[0])
+    result = await session.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    async for row in result:
+        yield row
+
+
+def _archived_keys_query(kind: str):
+    # В архиве только проданные ключи, поэтому для выгрузки свободных он не нужен
+    if kind == "free":
+        return None
+    query = select(
+        KeyArchive.key_id, KeyArchive.product_name, KeyArchive.name, KeyArchive.key_value, KeyArchive.key_file,
+        KeyArchive.used, KeyArchive.user_id, KeyArchive.purchase_date, KeyArchive.validity_period,
+        KeyArchive.expiration_date, KeyArchive.order_id, KeyArchive.id,
+    )
+    if kind == "expired":
+        query = query.where(KeyArchive.expiration_date.isnot(None), KeyArchive.expiration_date < datetime.utcnow())
+    return query
+
+
+async def orm_stream_sales(session: AsyncSession):
+    query = (
+        select(
+            Order.id, Order.created, Order.user_id, Order.status,
+            OrderLine.product_name, OrderLine.price, OrderLine.quantity,
+        )
+        .join(OrderLine, OrderLine.order_id == Order.id)
+        .order_by(Order.id, OrderLine.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    result = await session.stream(query)
+    async for row in result:
+        yield row
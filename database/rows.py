@@ -0,0 +1,41 @@
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+
+# Лёгкие модели для чтения на частых экранах (каталог, корзина, списки ключей).
+# Запросы в database.orm_query выбирают только нужные колонки и собирают из строк
+# эти объекты: без identity map, отслеживания изменений и загрузки связей.
+# Объекты только для чтения - менять данные нужно через функции orm_*.
+
+
+@dataclass(slots=True, frozen=True)
+class ProductRow:
+    id: int
+    name: str
+    description: str | None
+    price: Decimal
+    image: str | None
+    available_keys: int
+
+
+@dataclass(slots=True, frozen=True)
+class CartRow:
+    id: int
+    quantity: int
+    product_id: int
+    product_name: str
+    price: Decimal
+    image: str | None
+
+
+@dataclass(slots=True, frozen=True)
+class KeyRow:
+    id: int
+    name: str
+    product_name: str | None
+    user_id: int | None
+    used: int
+    reserved_for: int | None
+    validity_period: int | None
+    expiration_date: datetime | None
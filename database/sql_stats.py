@@ -0,0 +1,186 @@
+import logging
+import os
+import random
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+# Если один и тот же запрос (с точностью до параметров) выполняется за апдейт больше
+# стольких раз - скорее всего это N+1, пишем предупреждение в лог
+SQL_REPEAT_WARN = int(os.getenv('SQL_REPEAT_WARN', 10))
+# Сколько символов SQL хранить для самого медленного запроса
+SQL_TEXT_LIMIT = 200
+
+# Журнал медленных запросов: запросы дольше SLOW_QUERY_MS миллисекунд (0 - выключено)
+# с вероятностью SLOW_QUERY_SAMPLE пишутся вместе с параметрами и планом выполнения
+# в SLOW_QUERY_LOG (файл ротируется). Выборка держит накладные расходы на EXPLAIN
+# малыми, поэтому журнал можно не выключать в проде.
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 500))
+SLOW_QUERY_SAMPLE = float(os.getenv('SLOW_QUERY_SAMPLE', 0.1))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+# Длинные значения параметров (ключи, описания) в журнале обрезаются
+SLOW_QUERY_PARAM_LIMIT = 50
+# План строится только для запросов с данными, не для DDL, PRAGMA, COPY и т.п.
+EXPLAIN_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+slow_query_logger = logging.getLogger("slow_queries")
+
+
+# Запросы одного апдейта. Создаётся в middlewares.db.SqlStatsMiddleware и доступен
+# хукам движка через contextvar; запросы вне апдейтов (фоновые задачи) не учитываются
+class UpdateQueries:
+    def __init__(self):
+        self.handler = "unhandled"
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = ""
+        self.shapes = Counter()
+
+    def add(self, statement: str, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+            self.slowest_sql = statement[:SQL_TEXT_LIMIT]
+        self.shapes[statement] += 1
+        if self.shapes[statement] == SQL_REPEAT_WARN + 1:
+            logging.warning(
+                f"Возможный N+1 в {self.handler}: запрос выполнен больше {SQL_REPEAT_WARN} раз "
+                f"за апдейт: {statement[:SQL_TEXT_LIMIT]}"
+            )
+
+
+current_queries: ContextVar[UpdateQueries | None] = ContextVar("current_queries", default=None)
+
+
+# Сводка по хендлеру за время работы процесса
+class HandlerSqlStats:
+    def __init__(self):
+        self.updates = 0
+        self.queries = 0
+        self.total = 0.0
+        self.max_queries = 0
+        self.slowest = 0.0
+        self.slowest_sql = ""
+
+
+class SqlStats:
+    def __init__(self):
+        self.handlers: dict[str, HandlerSqlStats] = {}
+
+    def record(self, queries: UpdateQueries):
+        stats = self.handlers.get(queries.handler)
+        if stats is None:
+            stats = self.handlers[queries.handler] = HandlerSqlStats()
+        stats.updates += 1
+        stats.queries += queries.count
+        stats.total += queries.total
+        stats.max_queries = max(stats.max_queries, queries.count)
+        if queries.slowest > stats.slowest:
+            stats.slowest = queries.slowest
+            stats.slowest_sql = queries.slowest_sql
+
+    def top(self, limit: int=10) -> list[tuple[str, HandlerSqlStats]]:
+        # Хендлеры, которые суммарно дольше всего ждали БД
+        return sorted(self.handlers.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+
+sql_stats = SqlStats()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    queries = current_queries.get()
+    if queries is not None:
+        queries.add(statement, elapsed)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS and random.random() < SLOW_QUERY_SAMPLE:
+        _log_slow_query(conn, statement, parameters, executemany, elapsed)
+
+
+def _short_params(parameters):
+    if isinstance(parameters, dict):
+        return {name: _short_params(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_short_params(value) for value in parameters]
+    if isinstance(parameters, str) and len(parameters) > SLOW_QUERY_PARAM_LIMIT:
+        return parameters[:SLOW_QUERY_PARAM_LIMIT] + "..."
+    if isinstance(parameters, bytes):
+        return f"<{len(parameters)} байт>"
+    return parameters
+
+
+def _explain(conn, statement: str, parameters) -> str:
+    # План берётся отдельным курсором DBAPI-соединения: в обход событий движка
+    # (EXPLAIN не попадает в статистику и не вызывает этот хук повторно)
+    # и без затрагивания курсора, из которого ещё читается результат запроса
+    if not statement.lstrip().upper().startswith(EXPLAIN_PREFIXES):
+        return "(план не строится для этого запроса)"
+    postgresql = conn.dialect.name == "postgresql"
+    prefix = "EXPLAIN " if postgresql else "EXPLAIN QUERY PLAN "
+    cursor = conn.connection.cursor()
+    try:
+        # В Postgres ошибка прерывает всю транзакцию - изолируем EXPLAIN точкой сохранения
+        if postgresql:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as e:
+            if postgresql:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return f"(не удалось получить план: {e})"
+        finally:
+            if postgresql:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+    # EXPLAIN в Postgres - одна колонка с текстом, EXPLAIN QUERY PLAN в SQLite - (id, parent, notused, detail)
+    plan = "\n".join(row[0] if postgresql else row[-1] for row in rows)
+    return plan or "(пустой план)"
+
+
+def _log_slow_query(conn, statement: str, parameters, executemany: bool, elapsed: float):
+    queries = current_queries.get()
+    handler = queries.handler if queries is not None else "-"
+    if executemany:
+        # План по первому набору параметров
+        parameters = parameters[0] if parameters else ()
+    try:
+        plan = _explain(conn, statement, parameters)
+    except Exception as e:
+        plan = f"(не удалось получить план: {e})"
+    slow_query_logger.warning(
+        f"{elapsed * 1000:.1f} мс, хендлер {handler}{' (executemany)' if executemany else ''}\n"
+        f"{statement}\n"
+        f"Параметры: {_short_params(parameters)!r}\n"
+        f"План:\n{plan}\n"
+    )
+
+
+def _handle_error(context):
+    # Упавший запрос не доходит до after_cursor_execute - убираем его время старта
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+def install_sql_stats(engine: AsyncEngine):
+    if SLOW_QUERY_MS and not slow_query_logger.handlers:
+        handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_logger.addHandler(handler)
+        slow_query_logger.setLevel(logging.WARNING)
+        # Медленные запросы пишутся только в свой файл, не в общий лог
+        slow_query_logger.propagate = False
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine.sync_engine, "handle_error", _handle_error)
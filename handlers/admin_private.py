@@ -1,7 +1,11 @@
+import html
 import logging
 import os
+import tempfile
+import time
 from dotenv import load_dotenv
 from aiogram import F, Router, types, Bot
+from aiogram.types import FSInputFile
 from aiogram.filters import Command, StateFilter, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -20,17 +24,35 @@ from database.orm_query import (
     orm_get_products,
     orm_update_product,
     orm_add_key,
+    orm_import_keys,
+    orm_stream_keys,
+    orm_stream_sales,
+    KEY_EXPORT_COLUMNS,
+    SALES_EXPORT_COLUMNS,
     orm_delete_key,
     orm_update_key,
-    orm_get_all_keys,
-    orm_get_free_keys,
-    orm_get_expired_keys,
+    orm_browse_keys,
+    orm_get_product_names,
+    orm_key_browser_query,
+    KEY_STATUSES,
+    BULK_DELETE,
+    BULK_EXTEND,
+    BULK_MOVE,
+    orm_bulk_keys,
+    orm_bulk_keys_query,
+    orm_count,
 )
 
 from filters.chat_types import ChatTypeFilter, IsAdmin
-from kbds.inline import get_callback_btns
+from kbds.inline import KeyBrowserCallBack, get_callback_btns
 from kbds.reply import get_keyboard
 from database.models import Key
+from database.sql_stats import sql_stats
+from middlewares.db import session_stats
+from utils.cache import known_users, menu_cache
+from utils.export import write_csv
+from utils.key_import import IMPORT_FORMATS, KeyFileReader
+from utils.outbound import outbound
 
 # Загрузка переменных окружения из .env
 load_dotenv()
@@ -55,18 +77,72 @@ ADMIN_INLINE_KB = get_callback_btns(
 KEYS_INLINE_KB = get_callback_btns(
     btns={
         "Добавить ключ": "add_key",
+        "Импорт ключей": "import_keys",
         "Удалить ключ": "delete_key",
         "Изменить ключ": "edit_key",
         "Список ключей": "list_keys",
+        "Выгрузка CSV": "export_menu",
         "Назад": "back_to_main",
     },
     sizes=(2,)
 )
 
+# Сколько ключей показывать на одной странице списков
+KEYS_PER_PAGE = 10
+
+# Курсоры соседних страниц для постраничных списков ключей (листание по id, см. orm_browse_keys)
+def keys_page_cursors(keys: list[Key], has_more: bool, after: int, before: int) -> dict[str, tuple[int, int]]:
+    cursors = {}
+    if keys and (after or (before and has_more)):
+        cursors["◀ Пред."] = (0, keys[0].id)
+    if keys and (before or has_more):
+        cursors["След. ▶"] = (keys[-1].id, 0)
+    return cursors
+
+# Кнопки навигации с callback_data вида "{prefix}a_{id}" / "{prefix}b_{id}"
+def keys_pagination_btns(keys: list[Key], has_more: bool, after: int, before: int, prefix: str) -> dict:
+    return {
+        text: f"{prefix}a_{cursor_after}" if cursor_after else f"{prefix}b_{cursor_before}"
+        for text, (cursor_after, cursor_before) in keys_page_cursors(keys, has_more, after, before).items()
+    }
+
+# Страница из callback_data вида "{prefix}a_{id}" / "{prefix}b_{id}"
+def keys_page_cursor(data: str, prefix: str) -> tuple[int, int]:
+    if not data.startswith(prefix):
+        return 0, 0
+    direction, key_id = data.removeprefix(prefix).split("_")
+    return (int(key_id), 0) if direction == "a" else (0, int(key_id))
+
 @admin_router.message(Command("admin"))
 async def admin_features(message: types.Message):
     await message.answer("Что хотите сделать?", reply_markup=ADMIN_INLINE_KB)
 
+# Сводка о работе бота: очередь отправки, сессии БД, кэши и SQL-запросы по хендлерам
+@admin_router.message(Command("stats"))
+async def stats_cmd(message: types.Message):
+    queue = outbound.stats()
+    sessions = session_stats.as_dict()
+    text = (
+        "<strong>Очередь отправки</strong>\n"
+        f"В очереди: {queue['depth']} | Отправлено: {queue['sent']} | Ошибок: {queue['failed']} | Повторов: {queue['retries']}\n"
+        f"Задержка: средняя {queue['avg_latency']} с, макс. {queue['max_latency']} с\n\n"
+        "<strong>Сессии БД</strong>\n"
+        f"Апдейтов: {sessions['updates']} | С сессией: {sessions['sessions']} | Без БД: {sessions['without_session']}\n\n"
+        "<strong>Кэши</strong>\n"
+        f"Меню: {len(menu_cache)} записей, попаданий {menu_cache.hits}, промахов {menu_cache.misses}\n"
+        f"Пользователи: {len(known_users)} записей, попаданий {known_users.hits}, промахов {known_users.misses}\n\n"
+        "<strong>SQL по хендлерам</strong> (по суммарному времени)\n"
+    )
+    for name, stats in sql_stats.top():
+        text += (
+            f"{html.escape(name)}: {stats.updates} апд., {stats.queries} запросов "
+            f"(в среднем {stats.queries / stats.updates:.1f}, макс. {stats.max_queries}), "
+            f"{stats.total * 1000:.0f} мс\n"
+        )
+        if stats.slowest_sql:
+            text += f"  медленный: {stats.slowest * 1000:.1f} мс <code>{html.escape(stats.slowest_sql[:100])}</code>\n"
+    await message.answer(text)
+
 # Переход в подменю "Ключи"
 @admin_router.callback_query(F.data == "keys_menu")
 async def keys_menu_callback(callback: types.CallbackQuery):
@@ -113,16 +189,18 @@ async def add_key_callback(callback: types.CallbackQuery, state: FSMContext, ses
     await state.set_state(AddKey.product_id)
     await callback.answer()
 
-@admin_router.callback_query(F.data == "delete_key")
+@admin_router.callback_query(or_f(F.data == "delete_key", F.data.startswith("del_keys_page_")))
 async def delete_key_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
-    query = select(Key).where(Key.used == 0)
-    result = await session.execute(query)
-    keys = result.scalars().all()
+    after, before = keys_page_cursor(callback.data, "del_keys_page_")
+    keys, has_more = await orm_browse_keys(
+        session, orm_key_browser_query(status="free"), after=after, before=before, limit=KEYS_PER_PAGE
+    )
     if not keys:
         await callback.message.edit_text("Нет доступных ключей для удаления.", reply_markup=KEYS_INLINE_KB)
         await state.clear()
     else:
         btns = {f"{key.name} (ID: {key.id})": f"del_key_{key.id}" for key in keys}
+        btns.update(keys_pagination_btns(keys, has_more, after, before, "del_keys_page_"))
         await callback.message.edit_text(
             "Выберите ключ для удаления:",
             reply_markup=get_callback_btns(btns=btns)
@@ -130,16 +208,18 @@ async def delete_key_callback(callback: types.CallbackQuery, state: FSMContext,
         await state.set_state(DeleteKey.key_selection)
     await callback.answer()
 
-@admin_router.callback_query(F.data == "edit_key")
+@admin_router.callback_query(or_f(F.data == "edit_key", F.data.startswith("edit_keys_page_")))
 async def edit_key_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
-    query = select(Key).where(Key.used == 0)
-    result = await session.execute(query)
-    keys = result.scalars().all()
+    after, before = keys_page_cursor(callback.data, "edit_keys_page_")
+    keys, has_more = await orm_browse_keys(
+        session, orm_key_browser_query(status="free"), after=after, before=before, limit=KEYS_PER_PAGE
+    )
     if not keys:
         await callback.message.edit_text("Нет доступных ключей для изменения.", reply_markup=KEYS_INLINE_KB)
         await state.clear()
     else:
         btns = {f"{key.name} (ID: {key.id})": f"edit_key_{key.id}" for key in keys}
+        btns.update(keys_pagination_btns(keys, has_more, after, before, "edit_keys_page_"))
         await callback.message.edit_text(
             "Выберите ключ для изменения:",
             reply_markup=get_callback_btns(btns=btns)
@@ -148,19 +228,10 @@ async def edit_key_callback(callback: types.CallbackQuery, state: FSMContext, se
     await callback.answer()
 
 @admin_router.callback_query(F.data == "list_keys")
-async def list_keys_callback(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
-        "Выберите категорию ключей для просмотра:",
-        reply_markup=get_callback_btns(
-            btns={
-                "Все ключи": "view_all_keys",
-                "Свободные ключи": "view_free_keys",
-                "Просроченные ключи": "view_expired_keys",
-                "Назад": "back_to_keys",
-            }
-        )
-    )
-    await state.set_state(ViewKeys.key_list)
+async def list_keys_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    await state.update_data(key_prefix=None)
+    text, reply_markup = await key_browser_content(session, state, KeyBrowserCallBack())
+    await callback.message.edit_text(text, reply_markup=reply_markup)
     await callback.answer()
 
 @admin_router.callback_query(F.data == "back_to_keys")
@@ -185,7 +256,8 @@ async def starring_at_product(callback: types.CallbackQuery, session: AsyncSessi
         for product in products:
             await callback.message.answer_photo(
                 product.image,
-                caption=f"<strong>{product.name}</strong>\n{product.description}\nСтоимость: {round(product.price, 2)}",
+                caption=f"<strong>{product.name}</strong>\n{product.description}\nСтоимость: {round(product.price, 2)}"
+                        f"\nОстаток ключей: {product.available_keys}",
                 reply_markup=get_callback_btns(
                     btns={
                         "Удалить": f"delete_{product.id}",
@@ -508,6 +580,171 @@ async def add_validity_period(message: types.Message, state: FSMContext, session
     finally:
         await state.clear()
 
+######################### FSM для массового импорта ключей ###################
+
+class ImportKeys(StatesGroup):
+    product_id = State()
+    validity_period = State()
+    file = State()
+
+# Как часто обновлять сообщение с ходом импорта (в секундах)
+IMPORT_PROGRESS_INTERVAL = 2
+
+@admin_router.callback_query(F.data == "import_keys")
+async def import_keys_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    categories = await orm_get_categories(session)
+    btns = {category.name: f"imp_cat_{category.id}" for category in categories}
+    await callback.message.edit_text(
+        "Выберите категорию продукта для импорта ключей",
+        reply_markup=get_callback_btns(btns=btns)
+    )
+    await state.set_state(ImportKeys.product_id)
+    await callback.answer()
+
+@admin_router.callback_query(ImportKeys.product_id, F.data.startswith("imp_cat_"))
+async def import_select_category(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    category_id = int(callback.data.split("_")[-1])
+    products = await orm_get_products(session, category_id)
+    if not products:
+        await callback.message.edit_text("В этой категории нет продуктов!", reply_markup=KEYS_INLINE_KB)
+        await state.clear()
+    else:
+        btns = {product.name: f"imp_prod_{product.id}" for product in products}
+        await callback.message.edit_text("Выберите продукт", reply_markup=get_callback_btns(btns=btns))
+    await callback.answer()
+
+@admin_router.callback_query(ImportKeys.product_id, F.data.startswith("imp_prod_"))
+async def import_select_product(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    product_id = int(callback.data.split("_")[-1])
+    product = await orm_get_product(session, product_id)
+    if not product:
+        await callback.message.edit_text("Продукт не найден!", reply_markup=KEYS_INLINE_KB)
+        await state.clear()
+    else:
+        await state.update_data(product_id=product_id, product_name=product.name)
+        await callback.message.edit_text(
+            "Введите срок действия ключей в днях (или '-' для бессрочных).\n"
+            "Срок из колонки validity_period в CSV имеет приоритет."
+        )
+        await state.set_state(ImportKeys.validity_period)
+    await callback.answer()
+
+@admin_router.message(ImportKeys.product_id)
+async def import_invalid_product(message: types.Message, state: FSMContext):
+    await message.answer("Выберите продукт из кнопок!")
+
+@admin_router.message(ImportKeys.validity_period, F.text)
+async def import_validity_period(message: types.Message, state: FSMContext):
+    validity_period = None
+    if message.text != "-":
+        try:
+            validity_period = int(message.text)
+            if validity_period <= 0:
+                await message.answer("Срок действия должен быть положительным числом. Введите заново.")
+                return
+        except ValueError:
+            await message.answer("Введите число дней или '-' для бессрочных ключей.")
+            return
+    await state.update_data(validity_period=validity_period)
+    await message.answer(
+        f"Загрузите файл с ключами ({', '.join(IMPORT_FORMATS)}):\n"
+        "CSV - колонки key_value, name, validity_period;\n"
+        "TXT - по одному ключу на строку;\n"
+        "ZIP - файлы конфигураций, название ключа = имя файла."
+    )
+    await state.set_state(ImportKeys.file)
+
+@admin_router.message(ImportKeys.validity_period)
+async def import_invalid_validity_period(message: types.Message, state: FSMContext):
+    await message.answer("Введите число дней или '-' для бессрочных ключей.")
+
+@admin_router.message(ImportKeys.file, F.document)
+async def import_keys_file(message: types.Message, state: FSMContext, session: AsyncSession):
+    data = await state.get_data()
+    filename = message.document.file_name or ""
+    if not filename.lower().endswith(IMPORT_FORMATS):
+        await message.answer(f"Поддерживаются файлы {', '.join(IMPORT_FORMATS)}. Загрузите файл заново.")
+        return
+
+    status = await message.answer("Импорт ключей: загрузка файла...")
+    last_update = time.monotonic()
+
+    async def progress(added: int, duplicates: int):
+        nonlocal last_update
+        if time.monotonic() - last_update < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_update = time.monotonic()
+        await status.edit_text(f"Импорт ключей: добавлено {added}, дублей {duplicates}...")
+
+    # Файл читается с диска построчно, в память целиком не загружается
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "keys" + os.path.splitext(filename)[1].lower())
+        try:
+            await message.bot.download(message.document, destination=path)
+            reader = KeyFileReader(path, filename, default_name=data["product_name"])
+            added, duplicates = await orm_import_keys(
+                session,
+                product_id=data["product_id"],
+                rows=reader,
+                validity_period=data["validity_period"],
+                progress=progress,
+            )
+        except Exception as e:
+            logging.error(f"Ошибка импорта ключей из файла {filename}: {e}")
+            await status.edit_text(f"Ошибка при импорте ключей: {str(e)}", reply_markup=KEYS_INLINE_KB)
+            await state.clear()
+            return
+
+    await status.edit_text(
+        f"Импорт завершён.\nДобавлено ключей: {added}\nДублей: {duplicates}\nПропущено строк: {reader.skipped}",
+        reply_markup=KEYS_INLINE_KB
+    )
+    await state.clear()
+
+@admin_router.message(ImportKeys.file)
+async def import_invalid_file(message: types.Message, state: FSMContext):
+    await message.answer("Загрузите файл с ключами (документ)!")
+
+######################### Выгрузка ключей и продаж в CSV ###################
+
+EXPORT_KB = get_callback_btns(
+    btns={
+        "Все ключи": "export_keys_all",
+        "Свободные ключи": "export_keys_free",
+        "Просроченные ключи": "export_keys_expired",
+        "Продажи": "export_sales",
+        "Назад": "back_to_keys",
+    },
+    sizes=(2,)
+)
+
+@admin_router.callback_query(F.data == "export_menu")
+async def export_menu_callback(callback: types.CallbackQuery):
+    await callback.message.edit_text("Что выгрузить?", reply_markup=EXPORT_KB)
+    await callback.answer()
+
+@admin_router.callback_query(or_f(F.data.startswith("export_keys_"), F.data == "export_sales"))
+async def export_callback(callback: types.CallbackQuery, session: AsyncSession):
+    await callback.answer("Готовлю файл...")
+    if callback.data == "export_sales":
+        filename, columns, rows = "sales.csv", SALES_EXPORT_COLUMNS, orm_stream_sales(session)
+    else:
+        kind = callback.data.removeprefix("export_keys_")
+        filename, columns, rows = f"keys_{kind}.csv", KEY_EXPORT_COLUMNS, orm_stream_keys(session, kind)
+
+    # Строки пишутся во временный файл по мере чтения из БД
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, filename)
+        try:
+            count = await write_csv(path, columns, rows)
+            await callback.message.answer_document(
+                FSInputFile(path, filename=f"{datetime.now():%Y%m%d_%H%M}_{filename}"),
+                caption=f"Строк: {count}",
+            )
+        except Exception as e:
+            logging.error(f"Ошибка выгрузки {filename}: {e}")
+            await callback.message.answer(f"Ошибка при выгрузке: {str(e)}", reply_markup=KEYS_INLINE_KB)
+
 ######################### FSM для удаления ключей админом ###################
 
 class DeleteKey(StatesGroup):
@@ -680,50 +917,114 @@ async def invalid_new_value(message: types.Message, state: FSMContext):
 ######################### FSM для просмотра ключей и отправки сообщений ###################
 
 class ViewKeys(StatesGroup):
-    key_list = State()
     key_action = State()
+    search = State()
+    bulk_days = State()
 
 class SendMessage(StatesGroup):
     message_type = State()
     custom_message = State()
 
-@admin_router.callback_query(ViewKeys.key_list, F.data.in_(["view_all_keys", "view_free_keys", "view_expired_keys"]))
-async def view_keys(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
-    if callback.data == "view_all_keys":
-        keys = await orm_get_all_keys(session)
-        title = "Все ключи:"
-    elif callback.data == "view_free_keys":
-        keys = await orm_get_free_keys(session)
-        title = "Свободные ключи:"
-    elif callback.data == "view_expired_keys":
-        keys = await orm_get_expired_keys(session)
-        title = "Просроченные ключи:"
+# Подписи фильтров браузера ключей; кнопка фильтра переключает его на следующее значение
+KEY_STATUS_TITLES = {"all": "все", "free": "свободные", "reserved": "отложенные", "sold": "проданные"}
+KEY_EXPIRY_TITLES = {0: "любой", 7: "до 7 дней", 30: "до 30 дней", -1: "истёк"}
+
+def next_value(values, current):
+    values = list(values)
+    return values[(values.index(current) + 1) % len(values)] if current in values else values[0]
 
+async def key_browser_content(session: AsyncSession, state: FSMContext, filters: KeyBrowserCallBack):
+    data = await state.get_data()
+    prefix = data.get("key_prefix")
+    query = orm_key_browser_query(filters.product_id, filters.status, filters.expiry, prefix)
+    keys, has_more = await orm_browse_keys(
+        session, query, after=filters.after, before=filters.before, limit=KEYS_PER_PAGE
+    )
+    # Запоминаем текущую страницу, чтобы вернуться к ней из карточки ключа или после поиска
+    await state.update_data(key_browser=filters.model_copy(update={"action": "page"}).pack())
+    await state.set_state(ViewKeys.key_action)
+
+    product_title = "все"
+    if filters.product_id:
+        product = await orm_get_product(session, filters.product_id)
+        product_title = product.name if product else "не найден"
+    response = (
+        f"Ключи | Товар: {product_title} | Статус: {KEY_STATUS_TITLES.get(filters.status, filters.status)} | "
+        f"Окончание: {KEY_EXPIRY_TITLES.get(filters.expiry, filters.expiry)}"
+        + (f" | Поиск: {prefix}" if prefix else "")
+        + "\n\n"
+    )
     if not keys:
-        await callback.message.edit_text(f"{title}\nКлючи не найдены.", reply_markup=KEYS_INLINE_KB)
-        await state.clear()
-    else:
-        response = f"{title}\n"
-        btns = {}
-        for key in keys:
-            status = "Свободен" if not key.used else f"Куплен (ID: {key.user_id})"
-            expiration = key.expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC') if key.expiration_date else "Бессрочный"
-            response += (
-                f"ID: {key.id} | Товар: {key.product.name} | Название: {key.name}\n"
-                f"Статус: {status} | Срок: {key.validity_period or 'Нет'} дней | Окончание: {expiration}\n\n"
-            )
-            btns[f"Ключ {key.id}"] = f"key_action_{key.id}"
-        btns["Назад"] = "back_to_list"
-        await callback.message.edit_text(response, reply_markup=get_callback_btns(btns=btns, sizes=(2,)))
-        await state.set_state(ViewKeys.key_action)
-    await callback.answer()
+        response += "Ключи не найдены."
 
-@admin_router.callback_query(ViewKeys.key_list, F.data == "cancel")
-async def cancel_view_keys(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text("Выберите действие с ключами:", reply_markup=KEYS_INLINE_KB)
-    await state.clear()
+    btns = {}
+    for key in keys:
+        if key.used:
+            status = f"Куплен (ID: {key.user_id})"
+        elif key.reserved_for is not None:
+            status = f"Отложен для {key.reserved_for}"
+        else:
+            status = "Свободен"
+        expiration = key.expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC') if key.expiration_date else "Бессрочный"
+        response += (
+            f"ID: {key.id} | Товар: {key.product_name} | Название: {key.name}\n"
+            f"Статус: {status} | Срок: {key.validity_period or 'Нет'} дней | Окончание: {expiration}\n\n"
+        )
+        btns[f"Ключ {key.id}"] = f"key_action_{key.id}"
+
+    # Навигация и фильтры; смена фильтра начинает список с первой страницы
+    first_page = filters.model_copy(update={"action": "page", "after": 0, "before": 0})
+    for text, (after, before) in keys_page_cursors(keys, has_more, filters.after, filters.before).items():
+        btns[text] = filters.model_copy(update={"action": "page", "after": after, "before": before}).pack()
+    btns["Товар"] = first_page.model_copy(update={"action": "products"}).pack()
+    btns[f"Статус: {KEY_STATUS_TITLES.get(filters.status)}"] = first_page.model_copy(
+        update={"status": next_value(KEY_STATUSES, filters.status)}
+    ).pack()
+    btns[f"Окончание: {KEY_EXPIRY_TITLES.get(filters.expiry)}"] = first_page.model_copy(
+        update={"expiry": next_value(KEY_EXPIRY_TITLES, filters.expiry)}
+    ).pack()
+    btns["Поиск"] = first_page.model_copy(update={"action": "search"}).pack()
+    btns["Сброс"] = KeyBrowserCallBack(action="reset").pack()
+    btns["Массовые действия"] = "keys_bulk"
+    btns["Назад"] = "back_to_keys"
+    return response, get_callback_btns(btns=btns, sizes=(2,))
+
+@admin_router.callback_query(KeyBrowserCallBack.filter())
+async def key_browser(callback: types.CallbackQuery, callback_data: KeyBrowserCallBack, state: FSMContext, session: AsyncSession):
+    if callback_data.action == "products":
+        # Выбор товара для фильтра
+        btns = {"Все товары": callback_data.model_copy(update={"action": "page", "product_id": 0}).pack()}
+        for product_id, name in await orm_get_product_names(session):
+            btns[name] = callback_data.model_copy(update={"action": "page", "product_id": product_id}).pack()
+        await callback.message.edit_text("Выберите товар:", reply_markup=get_callback_btns(btns=btns))
+        await callback.answer()
+        return
+    if callback_data.action == "search":
+        await state.update_data(key_browser=callback_data.model_copy(update={"action": "page"}).pack())
+        await callback.message.edit_text("Введите начало названия или ID ключа (или '-' для сброса поиска):")
+        await state.set_state(ViewKeys.search)
+        await callback.answer()
+        return
+    if callback_data.action == "reset":
+        await state.update_data(key_prefix=None)
+
+    text, reply_markup = await key_browser_content(session, state, callback_data)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
     await callback.answer()
 
+@admin_router.message(ViewKeys.search, F.text)
+async def key_browser_search(message: types.Message, state: FSMContext, session: AsyncSession):
+    prefix = None if message.text == "-" else message.text.strip()[:150]
+    await state.update_data(key_prefix=prefix)
+    data = await state.get_data()
+    filters = KeyBrowserCallBack.unpack(data["key_browser"])
+    text, reply_markup = await key_browser_content(session, state, filters)
+    await message.answer(text, reply_markup=reply_markup)
+
+@admin_router.message(ViewKeys.search)
+async def key_browser_invalid_search(message: types.Message, state: FSMContext):
+    await message.answer("Введите текст для поиска!")
+
 @admin_router.callback_query(ViewKeys.key_action, F.data.startswith("free_key_action_"))
 async def free_key_action(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     key_id = int(callback.data.split("_")[-1])
@@ -826,20 +1127,115 @@ async def key_action(callback: types.CallbackQuery, state: FSMContext, session:
             await state.set_state(ViewKeys.key_action)
     await callback.answer()
 
-@admin_router.callback_query(ViewKeys.key_action, F.data == "back_to_list")
-async def back_to_key_list(callback: types.CallbackQuery, state: FSMContext):
+######################### Массовые действия над выборкой ключей ###################
+
+# Текущие фильтры браузера ключей в виде аргументов orm_key_browser_query
+async def key_browser_filters(state: FSMContext) -> dict:
+    data = await state.get_data()
+    filters = KeyBrowserCallBack.unpack(data["key_browser"]) if data.get("key_browser") else KeyBrowserCallBack()
+    return {
+        "product_id": filters.product_id,
+        "status": filters.status,
+        "expiry": filters.expiry,
+        "prefix": data.get("key_prefix"),
+    }
+
+BULK_BACK_BTN = {"Назад": "back_to_list"}
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "keys_bulk")
+async def keys_bulk_menu(callback: types.CallbackQuery):
     await callback.message.edit_text(
-        "Выберите категорию ключей для просмотра:",
+        "Действие применяется ко всем ключам текущей выборки (с учётом фильтров и поиска):",
         reply_markup=get_callback_btns(
             btns={
-                "Все ключи": "view_all_keys",
-                "Свободные ключи": "view_free_keys",
-                "Просроченные ключи": "view_expired_keys",
-                "Назад": "back_to_keys",
+                "Удалить свободные": "keys_bulk_delete",
+                "Продлить срок": "keys_bulk_extend",
+                "Перенести в товар": "keys_bulk_move",
+                **BULK_BACK_BTN,
             }
         )
     )
-    await state.set_state(ViewKeys.key_list)
+    await callback.answer()
+
+# Подтверждение: показываем, сколько ключей затронет операция
+async def ask_bulk_confirmation(message: types.Message, state: FSMContext, session: AsyncSession, action: str, value=None, edit=True):
+    filters = await key_browser_filters(state)
+    count = await orm_count(session, orm_bulk_keys_query(action, **filters))
+    await state.update_data(bulk_action=action, bulk_value=value)
+    await state.set_state(ViewKeys.key_action)
+    descriptions = {
+        BULK_DELETE: "Будет удалено свободных ключей",
+        BULK_EXTEND: f"Срок будет продлён на {value} дн. у ключей",
+        BULK_MOVE: "Будет перенесено в другой товар свободных ключей",
+    }
+    text = f"{descriptions[action]}: {count}.\nПодтвердить?"
+    reply_markup = get_callback_btns(btns={"Подтвердить": "keys_bulk_confirm", **BULK_BACK_BTN})
+    if edit:
+        await message.edit_text(text, reply_markup=reply_markup)
+    else:
+        await message.answer(text, reply_markup=reply_markup)
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "keys_bulk_delete")
+async def keys_bulk_delete(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    await ask_bulk_confirmation(callback.message, state, session, BULK_DELETE)
+    await callback.answer()
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "keys_bulk_extend")
+async def keys_bulk_extend(callback: types.CallbackQuery, state: FSMContext):
+    await callback.message.edit_text("На сколько дней продлить срок действия ключей?")
+    await state.set_state(ViewKeys.bulk_days)
+    await callback.answer()
+
+@admin_router.message(ViewKeys.bulk_days, F.text)
+async def keys_bulk_extend_days(message: types.Message, state: FSMContext, session: AsyncSession):
+    try:
+        days = int(message.text)
+        if days <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("Введите положительное число дней.")
+        return
+    await ask_bulk_confirmation(message, state, session, BULK_EXTEND, value=days, edit=False)
+
+@admin_router.message(ViewKeys.bulk_days)
+async def keys_bulk_invalid_days(message: types.Message, state: FSMContext):
+    await message.answer("Введите положительное число дней.")
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "keys_bulk_move")
+async def keys_bulk_move(callback: types.CallbackQuery, session: AsyncSession):
+    btns = {name: f"keys_bulk_move_to_{product_id}" for product_id, name in await orm_get_product_names(session)}
+    await callback.message.edit_text(
+        "В какой товар перенести свободные ключи?",
+        reply_markup=get_callback_btns(btns={**btns, **BULK_BACK_BTN})
+    )
+    await callback.answer()
+
+@admin_router.callback_query(ViewKeys.key_action, F.data.startswith("keys_bulk_move_to_"))
+async def keys_bulk_move_to(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    product_id = int(callback.data.split("_")[-1])
+    await ask_bulk_confirmation(callback.message, state, session, BULK_MOVE, value=product_id)
+    await callback.answer()
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "keys_bulk_confirm")
+async def keys_bulk_confirm(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    data = await state.get_data()
+    filters = await key_browser_filters(state)
+    try:
+        count = await orm_bulk_keys(session, data["bulk_action"], value=data.get("bulk_value"), **filters)
+        text = f"Готово, затронуто ключей: {count}."
+    except Exception as e:
+        logging.error(f"Ошибка массовой операции {data.get('bulk_action')}: {e}")
+        text = f"Ошибка при выполнении операции: {str(e)}"
+    await state.update_data(bulk_action=None, bulk_value=None)
+    await callback.message.edit_text(text, reply_markup=get_callback_btns(btns={"К списку ключей": "back_to_list"}))
+    await callback.answer()
+
+@admin_router.callback_query(ViewKeys.key_action, F.data == "back_to_list")
+async def back_to_key_list(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    data = await state.get_data()
+    filters = KeyBrowserCallBack.unpack(data["key_browser"]) if data.get("key_browser") else KeyBrowserCallBack()
+    text, reply_markup = await key_browser_content(session, state, filters)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
     await callback.answer()
 
 @admin_router.callback_query(SendMessage.message_type, F.data == "send_expiration_notice")
@@ -860,8 +1256,8 @@ async def send_expiration_notice(callback: types.CallbackQuery, state: FSMContex
             f"{key.expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC')}.\n"
             "Для продления обратитесь к администратору."
         )
-        await callback.bot.send_message(key.user_id, notice)
-        await callback.message.edit_text("Уведомление об окончании срока действия отправлено.", reply_markup=KEYS_INLINE_KB)
+        outbound.send_message(key.user_id, notice)
+        await callback.message.edit_text("Уведомление об окончании срока действия поставлено в очередь отправки.", reply_markup=KEYS_INLINE_KB)
         await state.clear()
     await callback.answer()
 
@@ -891,7 +1287,8 @@ async def send_custom_message(message: types.Message, state: FSMContext, session
             return
 
         try:
-            await message.bot.send_message(
+            # Ждём результата из очереди, чтобы сообщить об ошибке доставки
+            await outbound.send_message(
                 key.user_id,
                 f"Сообщение от администратора:\n{message.text}",
                 reply_markup=get_callback_btns(
@@ -913,7 +1310,7 @@ async def send_custom_message(message: types.Message, state: FSMContext, session
             await state.clear()
             return
         try:
-            await message.bot.send_message(
+            await outbound.send_message(
                 ADMIN_ID,
                 f"Ответ от пользователя {user_id}:\n{message.text}",
                 reply_markup=get_callback_btns(
@@ -936,7 +1333,7 @@ async def send_custom_message(message: types.Message, state: FSMContext, session
             await state.clear()
             return
         try:
-            await message.bot.send_message(
+            await outbound.send_message(
                 user_id,
                 f"Ответ от администратора:\n{message.text}",
                 reply_markup=get_callback_btns(
@@ -962,16 +1359,11 @@ async def user_reply_to_admin(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @admin_router.callback_query(F.data.startswith("cancel_reply_"))
-async def cancel_user_reply(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
+async def cancel_user_reply(callback: types.CallbackQuery, state: FSMContext):
     user_id = int(callback.data.split("_")[-1])
     await callback.message.edit_text("Диалог завершён.")
-    try:
-        await bot.send_message(
-            ADMIN_ID,
-            f"Пользователь {user_id} завершил диалог."
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при уведомлении администратора о завершении диалога пользователем {user_id}: {str(e)}")
+    # Ошибку доставки залогирует очередь отправки
+    outbound.send_message(ADMIN_ID, f"Пользователь {user_id} завершил диалог.")
     await state.clear()
     await callback.answer()
 
@@ -985,15 +1377,10 @@ async def admin_reply_to_user(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @admin_router.callback_query(F.data.startswith("cancel_admin_reply_"))
-async def cancel_admin_reply(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
+async def cancel_admin_reply(callback: types.CallbackQuery, state: FSMContext):
     user_id = int(callback.data.split("_")[-1])
     await callback.message.edit_text("Диалог завершён.", reply_markup=KEYS_INLINE_KB)
-    try:
-        await bot.send_message(
-            user_id,
-            "Администратор завершил диалог."
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при уведомлении пользователя {user_id} о завершении диалога администратором: {str(e)}")
+    # Ошибку доставки залогирует очередь отправки
+    outbound.send_message(user_id, "Администратор завершил диалог.")
     await state.clear()
     await callback.answer()
\ No newline at end of file
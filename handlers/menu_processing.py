@@ -7,12 +7,15 @@ from database.orm_query import (
     orm_add_to_cart,
     orm_delete_from_cart,
     orm_get_banner,
-    orm_get_categories,
-    orm_get_products,
-    orm_get_user_carts,
     orm_reduce_product_in_cart,
-    orm_get_available_keys_count,
+    orm_categories_query,
+    orm_count_categories,
+    orm_products_query,
+    orm_count_products,
+    orm_user_carts_query,
+    orm_get_cart_summary,
 )
+from database.rows import CartRow, ProductRow
 from kbds.inline import (
     get_products_btns,
     get_user_cart,
@@ -20,7 +23,11 @@ from kbds.inline import (
     get_user_main_btns,
 )
 
-from utils.paginator import Paginator
+from utils.cache import menu_cache
+from utils.paginator import Paginator, QueryPaginator
+
+# Сколько категорий показывать на одной странице каталога
+CATEGORIES_PER_PAGE = 10
 
 
 async def main_menu(session, level, menu_name):
@@ -32,17 +39,25 @@ async def main_menu(session, level, menu_name):
     return image, kbds
 
 
-async def catalog(session, level, menu_name):
+async def catalog(session, level, menu_name, page):
     banner = await orm_get_banner(session, menu_name)
     image = InputMediaPhoto(media=banner.image, caption=banner.description)
 
-    categories = await orm_get_categories(session)
-    kbds = get_user_catalog_btns(level=level, categories=categories)
+    total = await orm_count_categories(session)
+    paginator = QueryPaginator(session, orm_categories_query(), total, page=page, per_page=CATEGORIES_PER_PAGE)
+    categories = await paginator.get_page()
+
+    kbds = get_user_catalog_btns(
+        level=level,
+        categories=categories,
+        page=page,
+        pagination_btns=pages(paginator),
+    )
 
     return image, kbds
 
 
-def pages(paginator: Paginator):
+def pages(paginator: Paginator | QueryPaginator):
     btns = dict()
     if paginator.has_previous():
         btns["◀ Пред."] = "previous"
@@ -56,14 +71,14 @@ def pages(paginator: Paginator):
 
 
 async def products(session, level, category, page):
-    # Получаем товары
-    products = await orm_get_products(session, category_id=category)
+    # Получаем только текущий товар, общее количество берём из кэша счётчиков
+    total = await orm_count_products(session, category_id=category)
 
-    paginator = Paginator(products, page=page)
-    product = paginator.get_page()[0]
+    paginator = QueryPaginator(session, orm_products_query(category), total, page=page, row_type=ProductRow)
+    product = (await paginator.get_page())[0]
 
-    # Получаем количество незадействованных ключей
-    available_keys = await orm_get_available_keys_count(session, product_id=product.id)
+    # Остаток незадействованных ключей хранится в самом товаре
+    available_keys = product.available_keys if product.available_keys > 0 else "нет в наличии"
 
     # Формируем подпись с остатком ключей
     image = InputMediaPhoto(
@@ -98,9 +113,9 @@ async def carts(session, level, menu_name, page, user_id, product_id):
     elif menu_name == "increment":
         await orm_add_to_cart(session, user_id, product_id)
 
-    carts = await orm_get_user_carts(session, user_id)
+    carts_count, total_price = await orm_get_cart_summary(session, user_id)
 
-    if not carts:
+    if not carts_count:
         banner = await orm_get_banner(session, "cart")
         image = InputMediaPhoto(
             media=banner.image, caption=f"<strong>{banner.description}</strong>"
@@ -114,17 +129,15 @@ async def carts(session, level, menu_name, page, user_id, product_id):
         )
 
     else:
-        paginator = Paginator(carts, page=page)
+        paginator = QueryPaginator(session, orm_user_carts_query(user_id), carts_count, page=page, row_type=CartRow)
 
-        cart = paginator.get_page()[0]
+        cart = (await paginator.get_page())[0]
 
-        cart_price = round(cart.quantity * cart.product.price, 2)
-        total_price = round(
-            sum(cart.quantity * cart.product.price for cart in carts), 2
-        )
+        cart_price = round(cart.quantity * cart.price, 2)
+        total_price = round(total_price, 2)
         image = InputMediaPhoto(
-            media=cart.product.image,
-            caption=f"<strong>{cart.product.name}</strong>\n{cart.product.price} USDT x {cart.quantity} = {cart_price} USDT\
+            media=cart.image,
+            caption=f"<strong>{cart.product_name}</strong>\n{cart.price} USDT x {cart.quantity} = {cart_price} USDT\
                     \nТовар {paginator.page} из {paginator.pages} в корзине.\nОбщая стоимость товаров в корзине {total_price} USDT",
         )
 
@@ -134,7 +147,7 @@ async def carts(session, level, menu_name, page, user_id, product_id):
             level=level,
             page=page,
             pagination_btns=pagination_btns,
-            product_id=cart.product.id,
+            product_id=cart.product_id,
         )
 
     return image, kbds
@@ -149,11 +162,19 @@ async def get_menu_content(
     product_id: int | None = None,
     user_id: int | None = None,
 ):
-    if level == 0:
-        return await main_menu(session, level, menu_name)
-    elif level == 1:
-        return await catalog(session, level, menu_name)
-    elif level == 2:
-        return await products(session, level, category, page)
+    # Экраны главного меню, каталога и товаров одинаковы для всех пользователей,
+    # поэтому отдаём их из кэша; корзина (level 3) всегда строится заново
+    if level in (0, 1, 2):
+        cache_key = (level, menu_name, category, page)
+        content = menu_cache.get(cache_key)
+        if content is None:
+            if level == 0:
+                content = await main_menu(session, level, menu_name)
+            elif level == 1:
+                content = await catalog(session, level, menu_name, page)
+            else:
+                content = await products(session, level, category, page)
+            menu_cache.set(cache_key, content)
+        return content
     elif level == 3:
         return await carts(session, level, menu_name, page, user_id, product_id)
@@ -11,12 +11,17 @@ from database.orm_query import (
     orm_add_user,
     orm_get_product,
     orm_get_user_carts,
-    orm_process_order_from_cart,
-    orm_get_available_keys_count,
+    orm_create_order,
+    orm_confirm_order,
+    orm_reject_order,
+    orm_reserve_cart,
+    orm_release_reservations,
 )
 from filters.chat_types import ChatTypeFilter
 from handlers.menu_processing import get_menu_content
 from kbds.inline import MenuCallBack, get_callback_btns
+from utils.delivery import deliver_keys
+from utils.outbound import outbound
 from database.models import Cart, Key
 
 user_private_router = Router()
@@ -60,12 +65,11 @@ async def process_order(callback: types.CallbackQuery, callback_data: MenuCallBa
         await callback.answer()
         return
 
-    # Проверка наличия всех товаров в корзине
-    unavailable_items = []
-    for cart in carts:
-        available_keys = await orm_get_available_keys_count(session, cart.product_id)
-        if available_keys < cart.quantity:
-            unavailable_items.append(f"{cart.product.name} (нужно {cart.quantity}, доступно {available_keys})")
+    # Откладываем ключи по всей корзине на время оплаты (или получаем список нехваток)
+    shortages = await orm_reserve_cart(session, user_id)
+    unavailable_items = [
+        f"{name} (нужно {quantity}, доступно {available})" for name, quantity, available in shortages
+    ]
 
     if unavailable_items:
         # Если есть товары с недостаточным количеством ключей, показываем главное меню
@@ -128,7 +132,8 @@ async def payment_confirmed(callback: types.CallbackQuery, state: FSMContext):
 
 # Обработка выбора "Отмена"
 @user_private_router.callback_query(OrderPayment.waiting_for_payment_confirmation, F.data == "cancel")
-async def payment_cancelled(callback: types.CallbackQuery, state: FSMContext):
+async def payment_cancelled(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
+    await orm_release_reservations(session, callback.from_user.id)
     await callback.message.edit_media(
         media=types.InputMediaPhoto(
             media=callback.message.photo[-1].file_id,
@@ -144,21 +149,25 @@ async def payment_cancelled(callback: types.CallbackQuery, state: FSMContext):
 async def process_screenshot(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     user_id = data["user_id"]
-    carts = await orm_get_user_carts(session, user_id)
-    total_price = sum(cart.product.price * cart.quantity for cart in carts)
-    product_list = "\n".join(f"{cart.product.name} ({cart.quantity} шт.)" for cart in carts)
+    # Фиксируем состав и цены корзины в заказе: дальнейшие изменения корзины его не затрагивают
+    order = await orm_create_order(session, user_id)
+    if not order:
+        await message.answer("Корзина пуста, заказ не оформлен.")
+        await state.clear()
+        return
+    product_list = "\n".join(f"{line.product_name} ({line.quantity} шт.)" for line in order.lines)
 
     # Отправляем скриншот администратору
-    await message.bot.send_photo(
+    outbound.send_photo(
         ADMIN_ID,
         photo=message.photo[-1].file_id,
         caption=f"Скриншот оплаты от пользователя {user_id}\n"
-                f"Корзина:\n{product_list}\n"
-                f"Итого: {total_price} руб.",
+                f"Заказ №{order.id}:\n{product_list}\n"
+                f"Итого: {order.total} USDT.",
         reply_markup=get_callback_btns(
             btns={
-                "Подтверждено": f"confirm_{user_id}",
-                "Не подтверждено": f"reject_{user_id}",
+                "Подтверждено": f"order_confirm_{order.id}",
+                "Не подтверждено": f"order_reject_{order.id}",
             },
             sizes=(2,)
         )
@@ -167,79 +176,76 @@ async def process_screenshot(message: types.Message, state: FSMContext, session:
     await state.clear()
 
 # Подтверждение оплаты администратором
-@user_private_router.callback_query(F.data.startswith("confirm_"))
+@user_private_router.callback_query(F.data.startswith("order_confirm_"))
 async def confirm_payment(callback: types.CallbackQuery, session: AsyncSession):
-    user_id = int(callback.data.split("_")[1])
-    carts = await orm_get_user_carts(session, user_id)
-    if not carts:
-        await callback.message.edit_caption("Корзина пользователя пуста!", reply_markup=None)
-        await callback.answer()
-        return
-
+    order_id = int(callback.data.split("_")[-1])
     try:
-        # Обрабатываем все товары в корзине и собираем ключи
-        all_keys = []
-        for cart in carts:
-            keys = await orm_process_order_from_cart(session, user_id, cart.product_id)
-            for key in keys:
-                all_keys.append((cart.product, key))
+        # Выдаём ключи по всему заказу одной транзакцией
+        result = await orm_confirm_order(session, order_id)
+    except ValueError as e:
+        # Заказ остаётся в ожидании: после пополнения ключей его можно подтвердить снова
+        await callback.answer(str(e), show_alert=True)
+        return
+    if result is None:
+        await callback.answer("Заказ уже обработан.")
+        return
+    order, all_keys = result
+    user_id = order.user_id
+    # Ключи уже выданы; сразу отвечаем на нажатие, доставка может занять несколько секунд
+    await callback.answer()
 
-        # Формируем сообщение с ключами в новом формате
-        response = (
-            "Ваша оплата подтверждена!\n"
-            "Инструкция по использованию ключей:\n"
-            "1. Скопируйте ключ или скачайте файл.\n"
-            "2. Используйте его в соответствующем приложении.\n\n"
-            "Полезные ссылки на инструкции:\n"
-            "1. [Скачать приложение для Android](https://play.google.com/store/apps/details?id=org.amnezia.vpn&hl=ru)\n"
-            "2. [Скачать приложение для Android TV](https://play.google.com/store/search?q=amneziawg&c=apps&hl=ru)\n"
-            "3. [Скачать приложение для iOS (инструкция)](https://docs.amnezia.org/ru/documentation/instructions/installing-amneziavpn-on-ios/)\n"
-            "4. [Подключение через ключ в виде текста](https://docs.amnezia.org/ru/documentation/instructions/connect-via-text-key)\n"
-            "5. [Подключение через файл конфигурации](https://docs.amnezia.org/ru/documentation/instructions/connect-via-config)\n"
-            "6. [Подключение AmneziaVPN на Android TV](https://docs.amnezia.org/ru/documentation/instructions/android_tv_connect)\n\n"
-            "*Ваши ключи:*\n"
-        )
-        for product, key in all_keys:
-            response += "Товар: {}\n".format(product.name)
-            response += "Дата приобретения: {}\n".format(key.purchase_date.strftime('%Y-%m-%d %H:%M:%S UTC'))
-            if key.validity_period:
-                response += "Срок действия: {} дней\n".format(key.validity_period)
-                response += "Дата окончания: {}\n".format(key.expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC'))
-            else:
-                response += "Срок действия: Бессрочный\n"
+    # Инструкция по использованию ключей
+    header = (
+        "Ваша оплата подтверждена!\n"
+        "Инструкция по использованию ключей:\n"
+        "1. Скопируйте ключ или скачайте файл.\n"
+        "2. Используйте его в соответствующем приложении.\n\n"
+        "Полезные ссылки на инструкции:\n"
+        "1. [Скачать приложение для Android](https://play.google.com/store/apps/details?id=org.amnezia.vpn&hl=ru)\n"
+        "2. [Скачать приложение для Android TV](https://play.google.com/store/search?q=amneziawg&c=apps&hl=ru)\n"
+        "3. [Скачать приложение для iOS (инструкция)](https://docs.amnezia.org/ru/documentation/instructions/installing-amneziavpn-on-ios/)\n"
+        "4. [Подключение через ключ в виде текста](https://docs.amnezia.org/ru/documentation/instructions/connect-via-text-key)\n"
+        "5. [Подключение через файл конфигурации](https://docs.amnezia.org/ru/documentation/instructions/connect-via-config)\n"
+        "6. [Подключение AmneziaVPN на Android TV](https://docs.amnezia.org/ru/documentation/instructions/android_tv_connect)\n\n"
+        "*Ваши ключи:*\n"
+    )
+    # Каждый ключ - отдельный блок: длинный ответ делится на сообщения только между ключами
+    blocks = []
+    files = []
+    for line, key in all_keys:
+        block = "Товар: {}\n".format(line.product_name)
+        block += "Дата приобретения: {}\n".format(key.purchase_date.strftime('%Y-%m-%d %H:%M:%S UTC'))
+        if key.validity_period:
+            block += "Срок действия: {} дней\n".format(key.validity_period)
+            block += "Дата окончания: {}\n".format(key.expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC'))
+        else:
+            block += "Срок действия: Бессрочный\n"
 
-            if key.key_value:
-                response += "Ключ: `{}`\n".format(key.key_value)
-            response += "\n"
+        if key.key_value:
+            block += "Ключ: `{}`\n".format(key.key_value)
+        blocks.append(block + "\n")
 
-            # Отправляем файл, если он есть
-            if key.key_file:
-                await callback.bot.send_document(user_id, key.key_file, caption=f"Товар: {product.name}")
+        # Файлы ключей отправляются медиагруппами
+        if key.key_file:
+            files.append((key.key_file, f"Товар: {line.product_name}"))
 
-        # Отправляем сообщение с Markdown-разметкой и отключённым превью
-        await callback.bot.send_message(user_id, response, parse_mode="Markdown", disable_web_page_preview=True)
+    try:
+        # Отправляем сообщения с Markdown-разметкой и отключённым превью
+        await deliver_keys(user_id, header, blocks, files, parse_mode="Markdown", disable_web_page_preview=True)
         await callback.message.edit_caption("Оплата подтверждена, пользователю отправлены ключи.", reply_markup=None)
-    except ValueError as e:
-        await callback.bot.send_message(user_id, str(e))
-        await callback.message.edit_caption(str(e), reply_markup=None)
     except Exception as e:
-        await callback.bot.send_message(user_id, f"Ошибка: {str(e)}")
+        outbound.send_message(user_id, f"Ошибка: {str(e)}")
         await callback.message.edit_caption(f"Ошибка: {str(e)}", reply_markup=None)
-    await callback.answer()
 
 # Отклонение оплаты администратором
-@user_private_router.callback_query(F.data.startswith("reject_"))
-async def reject_payment(callback: types.CallbackQuery):
-    user_id = int(callback.data.split("_")[1])
-    await callback.bot.send_message(user_id, "Ваша оплата не подтверждена администратором. Попробуйте снова.")
-    await callback.message.edit_caption("Оплата отклонена.", reply_markup=None)
-    await callback.answer()
-
-# Отклонение оплаты администратором
-@user_private_router.callback_query(F.data.startswith("reject_"))
-async def reject_payment(callback: types.CallbackQuery):
-    user_id = int(callback.data.split("_")[1])
-    await callback.bot.send_message(user_id, "Ваша оплата не подтверждена администратором. Попробуйте снова.")
+@user_private_router.callback_query(F.data.startswith("order_reject_"))
+async def reject_payment(callback: types.CallbackQuery, session: AsyncSession):
+    order_id = int(callback.data.split("_")[-1])
+    order = await orm_reject_order(session, order_id)
+    if order is None:
+        await callback.answer("Заказ уже обработан.")
+        return
+    outbound.send_message(order.user_id, "Ваша оплата не подтверждена администратором. Попробуйте снова.")
     await callback.message.edit_caption("Оплата отклонена.", reply_markup=None)
     await callback.answer()
 
@@ -11,6 +11,17 @@ class MenuCallBack(CallbackData, prefix="menu"):
     product_id: int | None = None
 
 
+# Фильтры и страница браузера ключей в админке (начало названия хранится в FSM,
+# т.к. callback_data ограничена 64 байтами)
+class KeyBrowserCallBack(CallbackData, prefix="kb"):
+    action: str = "page"
+    product_id: int = 0
+    status: str = "all"
+    expiry: int = 0
+    after: int = 0
+    before: int = 0
+
+
 def get_user_main_btns(*, level: int, sizes: tuple[int] = (2,)):
     keyboard = InlineKeyboardBuilder()
     btns = {
@@ -34,7 +45,14 @@ def get_user_main_btns(*, level: int, sizes: tuple[int] = (2,)):
     return keyboard.adjust(*sizes).as_markup()
 
 
-def get_user_catalog_btns(*, level: int, categories: list, sizes: tuple[int] = (2,)):
+def get_user_catalog_btns(
+    *,
+    level: int,
+    categories: list,
+    page: int = 1,
+    pagination_btns: dict | None = None,
+    sizes: tuple[int] = (2,)
+):
     keyboard = InlineKeyboardBuilder()
 
     keyboard.add(InlineKeyboardButton(text='Назад',
@@ -46,7 +64,18 @@ def get_user_catalog_btns(*, level: int, categories: list, sizes: tuple[int] = (
         keyboard.add(InlineKeyboardButton(text=c.name,
                 callback_data=MenuCallBack(level=level+1, menu_name=c.name, category=c.id).pack()))
 
-    return keyboard.adjust(*sizes).as_markup()
+    keyboard.adjust(*sizes)
+
+    row = []
+    for text, menu_name in (pagination_btns or {}).items():
+        if menu_name == "next":
+            row.append(InlineKeyboardButton(text=text,
+                    callback_data=MenuCallBack(level=level, menu_name='catalog', page=page + 1).pack()))
+        elif menu_name == "previous":
+            row.append(InlineKeyboardButton(text=text,
+                    callback_data=MenuCallBack(level=level, menu_name='catalog', page=page - 1).pack()))
+
+    return keyboard.row(*row).as_markup()
 
 
 def get_products_btns(
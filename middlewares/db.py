@@ -3,23 +3,120 @@ from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject
 
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
+from database.orm_query import UNIT_OF_WORK, orm_commit_unit_of_work
+from database.sql_stats import UpdateQueries, current_queries, sql_stats
 
+
+# Счётчики middleware: сколько апдейтов обработано и скольким из них понадобилась БД
+class SessionStats:
+    def __init__(self):
+        self.updates = 0
+        self.sessions = 0
+
+    @property
+    def without_session(self) -> int:
+        return self.updates - self.sessions
+
+    def as_dict(self) -> dict:
+        return {"updates": self.updates, "sessions": self.sessions, "without_session": self.without_session}
+
+
+session_stats = SessionStats()
+
+
+# Сессия, которая создаётся при первом обращении к любому её атрибуту.
+# Хендлеры, которые не трогают БД (чистка группы, шаги FSM), не создают
+# сессию и не берут соединение из пула.
+class LazySession:
+    __slots__ = ("_session_pool", "_session", "_unit_of_work")
+
+    def __init__(self, session_pool: async_sessionmaker, unit_of_work: bool=False):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+        self._unit_of_work = unit_of_work
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = self._session_pool()
+            # Функции orm_query только делают flush, коммит - один раз в конце апдейта
+            self._session.info[UNIT_OF_WORK] = self._unit_of_work
+            session_stats.sessions += 1
+        return getattr(self._session, name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+# unit_of_work - один коммит на апдейт (см. UNIT_OF_WORK в database.orm_query).
+# По умолчанию включён везде, кроме SQLite: там запись блокирует всю БД, и транзакция,
+# открытая на время ответов в Telegram, заставляет другие апдейты ждать блокировку.
 class DataBaseSession(BaseMiddleware):
-    def __init__(self, session_pool: async_sessionmaker):
+    def __init__(self, session_pool: async_sessionmaker, unit_of_work: bool | None=None):
         self.session_pool = session_pool
+        if unit_of_work is None:
+            unit_of_work = session_pool.kw["bind"].dialect.name != "sqlite"
+        self.unit_of_work = unit_of_work
+
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        session = LazySession(self.session_pool, self.unit_of_work)
+        session_stats.updates += 1
+        data['session'] = session
+        try:
+            result = await handler(event, data)
+            # Один коммит на апдейт; при исключении изменения откатятся при закрытии сессии
+            if session.opened and self.unit_of_work:
+                await orm_commit_unit_of_work(session)
+            return result
+        finally:
+            # Соединение возвращается в пул в конце апдейта, если сессия создавалась
+            await session.close()
 
 
+
+# Учёт SQL-запросов апдейта: количество, суммарное время и самый медленный запрос
+# (database.sql_stats). Вешается внешним middleware на dp.update
+class SqlStatsMiddleware(BaseMiddleware):
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data['session'] = session
+        queries = UpdateQueries()
+        token = current_queries.set(queries)
+        try:
             return await handler(event, data)
+        finally:
+            current_queries.reset(token)
+            sql_stats.record(queries)
+
+
+# Подписывает запросы апдейта именем хендлера, который его обработал.
+# Вешается внутренним middleware на dp.message и dp.callback_query
+class SqlHandlerNameMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        queries = current_queries.get()
+        if queries is not None and "handler" in data:
+            queries.handler = data["handler"].callback.__name__
+        return await handler(event, data)
 
 
 # class CounterMiddleware(BaseMiddleware):
@@ -0,0 +1,159 @@
+# Бенчмарк лёгких моделей чтения (database.rows) против загрузки ORM-сущностей.
+# Для экранов каталога (products()), корзины (carts()), списка ключей (view_keys)
+# и списка товаров в админке сравнивает прежний путь - select(сущность) с joinedload
+# связей - и текущие запросы orm_query, которые выбирают только нужные колонки.
+# Каждый вызов идёт в новой сессии, как в апдейте; меряется процессорное время
+# на вызов (включая чтение полей для подписи) и пик памяти по tracemalloc.
+#
+# Запуск из корня репозитория:
+#   python scripts/bench_read_models.py [--runs 300] [--keys 40]
+# По умолчанию используется временная SQLite; для Postgres задайте BENCH_DB_URL
+# (таблицы в этой БД будут пересозданы).
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp()
+os.environ['DB_URL'] = os.getenv('BENCH_DB_URL', f"sqlite+aiosqlite:///{_tmp_dir}/bench.db")
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import joinedload
+
+from database.engine import create_db, drop_db, engine, session_maker
+from database.models import Cart, Category, Key, Product
+from database.orm_query import (
+    orm_add_product,
+    orm_add_to_cart,
+    orm_add_user,
+    orm_browse_keys,
+    orm_get_products,
+    orm_key_browser_query,
+    orm_products_query,
+    orm_user_carts_query,
+)
+from database.rows import CartRow, ProductRow
+from utils.paginator import QueryPaginator
+
+USER_ID = 1
+PAGE_SIZE = 10
+
+
+async def prepare(keys: int) -> tuple[int, int]:
+    await drop_db()
+    await create_db()
+    async with session_maker() as session:
+        category_id = await session.scalar(select(Category.id))
+        for i in range(3):
+            await orm_add_product(session, dict(name=f"Товар {i}", description="d" * 200, price=1.5, image="img", category=category_id))
+        product_id = await session.scalar(select(Product.id).order_by(Product.id))
+        await orm_add_user(session, USER_ID)
+        await orm_add_to_cart(session, USER_ID, product_id)
+        await session.execute(insert(Key), [
+            dict(product_id=product_id, name=f"key {i}", key_value="v" * 300, description="x" * 100, used=0)
+            for i in range(keys)
+        ])
+        await session.commit()
+    return category_id, product_id
+
+
+def cases(category_id: int, product_id: int) -> dict:
+    # (ORM-сущности, проекция в строки) для каждого экрана; каждая функция
+    # возвращает поля, которые экран выводит в подписи или на кнопках
+    async def products_orm(session):
+        query = select(Product).where(Product.category_id == category_id).order_by(Product.id)
+        product = (await QueryPaginator(session, query, 3).get_page())[0]
+        return product.name, product.description, product.price, product.image, product.available_keys
+
+    async def products_rows(session):
+        query = orm_products_query(category_id)
+        product = (await QueryPaginator(session, query, 3, row_type=ProductRow).get_page())[0]
+        return product.name, product.description, product.price, product.image, product.available_keys
+
+    async def carts_orm(session):
+        query = select(Cart).where(Cart.user_id == USER_ID).options(joinedload(Cart.product)).order_by(Cart.id)
+        cart = (await QueryPaginator(session, query, 1).get_page())[0]
+        return cart.quantity, cart.product.name, cart.product.price, cart.product.image, cart.product.id
+
+    async def carts_rows(session):
+        query = orm_user_carts_query(USER_ID)
+        cart = (await QueryPaginator(session, query, 1, row_type=CartRow).get_page())[0]
+        return cart.quantity, cart.product_name, cart.price, cart.image, cart.product_id
+
+    async def keys_orm(session):
+        query = (
+            select(Key).where(Key.product_id == product_id).order_by(Key.id)
+            .options(joinedload(Key.product)).limit(PAGE_SIZE + 1)
+        )
+        keys = (await session.execute(query)).scalars().all()[:PAGE_SIZE]
+        return [(key.id, key.name, key.product.name, key.used, key.expiration_date) for key in keys]
+
+    async def keys_rows(session):
+        keys, _ = await orm_browse_keys(session, orm_key_browser_query(product_id), limit=PAGE_SIZE)
+        return [(key.id, key.name, key.product_name, key.used, key.expiration_date) for key in keys]
+
+    async def admin_products_orm(session):
+        query = select(Product).where(Product.category_id == category_id)
+        products = (await session.execute(query)).scalars().all()
+        return [(product.id, product.name, product.description, product.price, product.image) for product in products]
+
+    async def admin_products_rows(session):
+        products = await orm_get_products(session, category_id)
+        return [(product.id, product.name, product.description, product.price, product.image) for product in products]
+
+    return {
+        "каталог (products)": (products_orm, products_rows),
+        "корзина (carts)": (carts_orm, carts_rows),
+        f"ключи (view_keys, {PAGE_SIZE} шт.)": (keys_orm, keys_rows),
+        "товары в админке": (admin_products_orm, admin_products_rows),
+    }
+
+
+async def measure(read, runs: int) -> tuple[float, float]:
+    # Прогрев: компиляция запросов и пул соединений не должны попадать в замер
+    for _ in range(20):
+        async with session_maker() as session:
+            await read(session)
+    started = time.process_time()
+    for _ in range(runs):
+        async with session_maker() as session:
+            await read(session)
+    cpu_us = (time.process_time() - started) / runs * 1e6
+
+    async with session_maker() as session:
+        tracemalloc.start()
+        try:
+            await read(session)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return cpu_us, peak / 1024
+
+
+async def main(runs: int, keys: int):
+    engine.echo = False
+    try:
+        category_id, product_id = await prepare(keys)
+        print(f"{runs} вызовов на вариант, процессорное время на вызов и пик памяти")
+        for name, (orm_read, rows_read) in cases(category_id, product_id).items():
+            orm_cpu, orm_peak = await measure(orm_read, runs)
+            rows_cpu, rows_peak = await measure(rows_read, runs)
+            print(
+                f"{name:<26} ORM {orm_cpu:7.0f} мкс {orm_peak:6.1f} КиБ -> "
+                f"строки {rows_cpu:7.0f} мкс {rows_peak:6.1f} КиБ"
+            )
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Лёгкие модели чтения против ORM-сущностей")
+    parser.add_argument("--runs", type=int, default=300, help="сколько вызовов на каждый вариант")
+    parser.add_argument("--keys", type=int, default=40, help="сколько ключей у товара")
+    args = parser.parse_args()
+    asyncio.run(main(args.runs, args.keys))
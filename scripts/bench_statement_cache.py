@@ -0,0 +1,140 @@
+# Микробенчмарк кэша построения запросов (lambda_stmt в database.orm_query) для
+# orm_get_banner, orm_get_products и orm_get_user_carts. Сравнивает прежний путь -
+# новый select(...) на каждый вызов - с lambda_stmt:
+#   1) построение запроса и ключ кэша компиляции - работа SQLAlchemy на каждый вызов
+#      до обращения к БД (по ключу находится готовый скомпилированный SQL);
+#   2) вызов целиком с запросом к БД: прежний select против функции из orm_query.
+# В исходном замере была и orm_get_available_keys_count - она удалена из orm_query
+# как неиспользуемая, поэтому здесь её нет.
+#
+# Запуск из корня репозитория:
+#   python scripts/bench_statement_cache.py [--calls 20000] [--queries 3000]
+# По умолчанию используется временная SQLite; для Postgres задайте BENCH_DB_URL
+# (таблицы в этой БД будут пересозданы).
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp()
+os.environ['DB_URL'] = os.getenv('BENCH_DB_URL', f"sqlite+aiosqlite:///{_tmp_dir}/bench.db")
+
+from sqlalchemy import lambda_stmt, select
+from sqlalchemy.orm import joinedload
+
+from database.engine import create_db, drop_db, engine, session_maker
+from database.models import Banner, Cart, Category, Product
+from database.orm_query import (
+    PRODUCT_ROW_COLUMNS,
+    orm_add_product,
+    orm_add_to_cart,
+    orm_add_user,
+    orm_get_banner,
+    orm_get_products,
+    orm_get_user_carts,
+)
+from database.rows import ProductRow
+
+USER_ID = 1
+
+
+# Прежние версии функций: запрос строится заново при каждом вызове
+async def plain_get_banner(session, page: str):
+    return (await session.execute(select(Banner).where(Banner.name == page))).scalar()
+
+
+async def plain_get_products(session, category_id):
+    query = select(*PRODUCT_ROW_COLUMNS).where(Product.category_id == int(category_id))
+    return [ProductRow(*row) for row in await session.execute(query)]
+
+
+async def plain_get_user_carts(session, user_id):
+    query = select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product))
+    return (await session.execute(query)).scalars().all()
+
+
+# Те же запросы, что строят функции orm_query, парами (без кэша, с lambda_stmt)
+STATEMENTS = {
+    "orm_get_banner": (
+        lambda page: select(Banner).where(Banner.name == page),
+        lambda page: lambda_stmt(lambda: select(Banner).where(Banner.name == page)),
+    ),
+    "orm_get_products": (
+        lambda category_id: select(*PRODUCT_ROW_COLUMNS).where(Product.category_id == category_id),
+        lambda category_id: lambda_stmt(lambda: select(*PRODUCT_ROW_COLUMNS).where(Product.category_id == category_id)),
+    ),
+    "orm_get_user_carts": (
+        lambda user_id: select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product)),
+        lambda user_id: lambda_stmt(lambda: select(Cart).filter(Cart.user_id == user_id).options(joinedload(Cart.product))),
+    ),
+}
+
+
+async def prepare() -> int:
+    await drop_db()
+    await create_db()
+    async with session_maker() as session:
+        category_id = await session.scalar(select(Category.id))
+        await orm_add_product(session, dict(name="Товар", description="", price=1, image="", category=category_id))
+        product_id = await session.scalar(select(Product.id))
+        await orm_add_user(session, USER_ID)
+        await orm_add_to_cart(session, USER_ID, product_id)
+    return category_id
+
+
+def build_cost(build, argument, calls: int) -> float:
+    for _ in range(100):
+        build(argument)._generate_cache_key()
+    started = time.process_time()
+    for _ in range(calls):
+        build(argument)._generate_cache_key()
+    return (time.process_time() - started) / calls * 1e6
+
+
+async def call_cost(call, argument, queries: int) -> float:
+    async with session_maker() as session:
+        for _ in range(100):
+            await call(session, argument)
+        started = time.process_time()
+        for _ in range(queries):
+            await call(session, argument)
+            # Сущности не копятся в identity map между вызовами
+            session.expunge_all()
+        return (time.process_time() - started) / queries * 1e6
+
+
+async def main(calls: int, queries: int):
+    engine.echo = False
+    try:
+        category_id = await prepare()
+        arguments = {"orm_get_banner": "main", "orm_get_products": category_id, "orm_get_user_carts": USER_ID}
+        print(f"Построение запроса и ключ кэша, {calls} вызовов:")
+        for name, (plain, cached) in STATEMENTS.items():
+            before = build_cost(plain, arguments[name], calls)
+            after = build_cost(cached, arguments[name], calls)
+            print(f"  {name:<20} {before:7.1f} мкс -> {after:7.1f} мкс")
+
+        print(f"Вызов с запросом к БД, {queries} вызовов:")
+        functions = {
+            "orm_get_banner": (plain_get_banner, orm_get_banner),
+            "orm_get_products": (plain_get_products, orm_get_products),
+            "orm_get_user_carts": (plain_get_user_carts, orm_get_user_carts),
+        }
+        for name, (plain, cached) in functions.items():
+            before = await call_cost(plain, arguments[name], queries)
+            after = await call_cost(cached, arguments[name], queries)
+            print(f"  {name:<20} {before:7.0f} мкс -> {after:7.0f} мкс")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Стоимость построения запросов без кэша и с lambda_stmt")
+    parser.add_argument("--calls", type=int, default=20000, help="сколько раз строить каждый запрос")
+    parser.add_argument("--queries", type=int, default=3000, help="сколько раз вызывать каждую функцию с БД")
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.queries))
@@ -0,0 +1,146 @@
+# Нагрузочная проверка подтверждения заказов (database.orm_query.orm_confirm_order).
+# Создаёт пользователей с заказами на больше ключей, чем есть в наличии, и подтверждает
+# все заказы параллельно, каждый по два раза. Проверяет, что ни один ключ не выдан
+# дважды, ни один заказ не подтверждён дважды, заказы с отложенными ключами всегда
+# подтверждаются, заказы при нехватке остаются в ожидании, а счётчики остатков
+# совпадают с таблицей ключей.
+#
+# Запуск из корня репозитория:
+#   python scripts/stress_confirm_orders.py [--users 300] [--keys 150]
+# По умолчанию используется временная SQLite; для Postgres задайте STRESS_DB_URL
+# (таблицы в этой БД будут пересозданы).
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp()
+os.environ['DB_URL'] = os.getenv('STRESS_DB_URL', f"sqlite+aiosqlite:///{_tmp_dir}/stress.db")
+
+from sqlalchemy import func, insert, select
+
+from database.engine import create_db, drop_db, engine, session_maker
+from database.key_pool import key_pool
+from database.models import Category, Key, Order, OrderLine, Product, ORDER_CONFIRMED, ORDER_PENDING
+from database.orm_query import (
+    orm_add_product,
+    orm_add_to_cart,
+    orm_add_user,
+    orm_confirm_order,
+    orm_create_order,
+    orm_recount_available_keys,
+    orm_reserve_cart,
+)
+
+
+async def prepare(users: int, keys_per_product: int) -> list[int]:
+    await drop_db()
+    await create_db()
+    async with session_maker() as session:
+        category_id = await session.scalar(select(Category.id))
+        for name in ("A", "B"):
+            await orm_add_product(session, dict(name=name, description="", price=1, image="", category=category_id))
+        product_ids = (await session.execute(select(Product.id).order_by(Product.id))).scalars().all()
+        await session.execute(insert(Key), [
+            dict(product_id=product_id, name=f"key {product_id}-{i}", key_value=f"{product_id}-{i}", used=0)
+            for product_id in product_ids
+            for i in range(keys_per_product)
+        ])
+        await orm_recount_available_keys(session)
+    await key_pool.start(session_maker)
+
+    order_ids = []
+    for user_id in range(1, users + 1):
+        async with session_maker() as session:
+            await orm_add_user(session, user_id)
+            for product_id in random.sample(product_ids, random.randint(1, len(product_ids))):
+                for _ in range(random.randint(1, 2)):
+                    await orm_add_to_cart(session, user_id, product_id)
+            # Половина пользователей успевает отложить ключи до отправки скриншота
+            if user_id % 2:
+                await orm_reserve_cart(session, user_id)
+            order = await orm_create_order(session, user_id)
+            order_ids.append(order.id)
+    return order_ids
+
+
+async def confirm(order_id: int) -> str:
+    async with session_maker() as session:
+        try:
+            result = await orm_confirm_order(session, order_id)
+        except ValueError:
+            return "shortage"
+    return "confirmed" if result else "already"
+
+
+async def fully_reserved_orders() -> set[int]:
+    # Заказы, за которыми при оформлении закреплены ключи на все позиции
+    async with session_maker() as session:
+        ordered = dict((await session.execute(
+            select(OrderLine.order_id, func.sum(OrderLine.quantity)).group_by(OrderLine.order_id)
+        )).all())
+        reserved = dict((await session.execute(
+            select(Key.order_id, func.count()).where(Key.order_id.isnot(None)).group_by(Key.order_id)
+        )).all())
+    return {order_id for order_id, quantity in ordered.items() if reserved.get(order_id) == quantity}
+
+
+async def check(outcomes: list[str], reserved_orders: set[int]):
+    async with session_maker() as session:
+        statuses = dict((await session.execute(select(Order.status, func.count()).group_by(Order.status))).all())
+        ordered = dict((await session.execute(
+            select(Order.id, func.sum(OrderLine.quantity)).join(OrderLine).group_by(Order.id)
+            .where(Order.status == ORDER_CONFIRMED)
+        )).all())
+        sold = dict((await session.execute(
+            select(Key.order_id, func.count()).where(Key.used == 1).group_by(Key.order_id)
+        )).all())
+        sold_to_pending = await session.scalar(
+            select(func.count()).select_from(Key).join(Order, Key.order_id == Order.id)
+            .where(Key.used == 1, Order.status == ORDER_PENDING)
+        )
+        counters = (await session.execute(
+            select(Product.id, Product.available_keys, func.count(Key.id))
+            .outerjoin(Key, (Key.product_id == Product.id) & (Key.used == 0) & Key.reserved_for.is_(None))
+            .group_by(Product.id, Product.available_keys)
+        )).all()
+
+    print(f"Исходы подтверждений: { {name: outcomes.count(name) for name in set(outcomes)} }")
+    print(f"Заказы по статусам: {statuses}, с отложенными ключами: {len(reserved_orders)}, продано ключей: {sum(sold.values())}")
+    assert outcomes.count("confirmed") == statuses.get(ORDER_CONFIRMED, 0), "заказ подтверждён дважды"
+    assert sold == ordered, "число выданных ключей не совпадает с составом подтверждённых заказов"
+    assert sold_to_pending == 0, "ключи выданы по заказу, оставшемуся в ожидании"
+    assert reserved_orders <= set(ordered), "заказ с отложенными ключами не подтверждён"
+    for product_id, counter, free in counters:
+        assert counter == free, f"остаток товара {product_id}: счётчик {counter}, свободных ключей {free}"
+    print("OK: двойных выдач нет, счётчики остатков верны")
+
+
+async def main(users: int, keys_per_product: int):
+    engine.echo = False
+    try:
+        order_ids = await prepare(users, keys_per_product)
+        reserved_orders = await fully_reserved_orders()
+        started = time.perf_counter()
+        # Каждый заказ подтверждается дважды - как при повторном нажатии кнопки
+        tasks = [confirm(order_id) for order_id in order_ids * 2]
+        random.shuffle(tasks)
+        outcomes = await asyncio.gather(*tasks)
+        print(f"{len(tasks)} подтверждений за {time.perf_counter() - started:.2f} с")
+        await check(outcomes, reserved_orders)
+    finally:
+        await key_pool.stop()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Параллельное подтверждение заказов")
+    parser.add_argument("--users", type=int, default=300, help="сколько пользователей с заказами")
+    parser.add_argument("--keys", type=int, default=150, help="сколько ключей у каждого из двух товаров")
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.keys))
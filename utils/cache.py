@@ -0,0 +1,58 @@
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+# Простой LRU-кэш ограниченного размера: при переполнении вытесняется
+# запись, к которой дольше всего не обращались
+class LRUCache:
+    def __init__(self, maxsize: int=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] | None = None):
+        # Без условия очищаем кэш целиком, иначе удаляем ключи, подходящие под условие
+        if predicate is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Кэш отрисованных экранов меню: ключ (level, menu_name, category, page) -> (InputMediaPhoto, клавиатура).
+# Заполняется в handlers.menu_processing.get_menu_content, сбрасывается из database.orm_query
+menu_cache = LRUCache(maxsize=512)
+
+
+def invalidate_menu(level: int | None = None):
+    if level is None:
+        menu_cache.invalidate()
+    else:
+        menu_cache.invalidate(lambda key: key[0] == level)
+
+
+# user_id пользователей, которые точно есть в таблице user: повторные нажатия "Купить"
+# не обращаются к БД. Заполняется в database.orm_query.orm_add_user после коммита
+known_users = LRUCache(maxsize=int(os.getenv('KNOWN_USERS_CACHE_SIZE', 10000)))
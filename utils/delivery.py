@@ -0,0 +1,59 @@
+import asyncio
+
+from aiogram.types import BufferedInputFile, InputMediaDocument
+
+from utils.outbound import outbound
+
+
+# Лимиты Telegram: длина текста сообщения и число файлов в одной медиагруппе
+MESSAGE_LIMIT = 4096
+MEDIA_GROUP_LIMIT = 10
+
+
+def split_text(header: str, blocks: list[str], limit: int=MESSAGE_LIMIT) -> list[str]:
+    # Склеиваем блоки в сообщения не длиннее limit, разрезая только между блоками,
+    # чтобы разметка (например, `ключ`) никогда не рвалась посередине
+    chunks = []
+    current = header
+    for block in blocks:
+        if current and len(current) + len(block) > limit:
+            chunks.append(current)
+            current = ""
+        current += block
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def media_groups(files: list[tuple[str, str]], size: int=MEDIA_GROUP_LIMIT) -> list[list[InputMediaDocument]]:
+    # files - пары (file_id, подпись); пачки по size документов
+    return [
+        [InputMediaDocument(media=file_id, caption=caption) for file_id, caption in files[i:i + size]]
+        for i in range(0, len(files), size)
+    ]
+
+
+# Отправка ключей покупателю: файлы ключей уходят медиагруппами по 10 штук,
+# текст - сообщениями не длиннее лимита. Все запросы идут через очередь outbound,
+# которая ограничивает скорость и число параллельных запросов.
+# Возвращает число запросов к API.
+async def deliver_keys(chat_id: int, header: str, blocks: list[str], files: list[tuple[str, str]], **kwargs) -> int:
+    futures = []
+    for group in media_groups(files):
+        if len(group) == 1:
+            # Медиагруппа должна содержать от 2 до 10 элементов
+            futures.append(outbound.send_document(chat_id, group[0].media, caption=group[0].caption))
+        else:
+            futures.append(outbound.send_media_group(chat_id, group))
+
+    oversized = [block for block in blocks if len(block) > MESSAGE_LIMIT]
+    blocks = [block for block in blocks if len(block) <= MESSAGE_LIMIT]
+    for chunk in split_text(header, blocks):
+        futures.append(outbound.send_message(chat_id, chunk, **kwargs))
+    # Ключ, который сам по себе не помещается в сообщение, отправляем текстовым файлом
+    for number, block in enumerate(oversized, start=1):
+        document = BufferedInputFile(block.encode(), filename=f"key_{number}.txt")
+        futures.append(outbound.send_document(chat_id, document))
+
+    await asyncio.gather(*futures)
+    return len(futures)
@@ -0,0 +1,15 @@
+import csv
+from typing import AsyncIterator, Iterable
+
+
+# Пишет строки в CSV по мере получения: в памяти держится только текущая строка.
+# utf-8-sig - чтобы Excel правильно открывал кириллицу. Возвращает число строк.
+async def write_csv(path: str, columns: Iterable[str], rows: AsyncIterator) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        async for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
@@ -0,0 +1,99 @@
+import csv
+import hashlib
+import io
+import os
+import zipfile
+from typing import Iterator
+
+# Ограничения на импортируемые ключи
+MAX_NAME_LENGTH = 150
+MAX_KEY_LENGTH = 64 * 1024
+IMPORT_FORMATS = (".csv", ".txt", ".zip")
+
+
+def key_hash(key_value: str) -> str:
+    # Отпечаток значения ключа для поиска дублей по индексу (само значение - Text)
+    return hashlib.sha256(key_value.strip().encode()).hexdigest()
+
+
+# Потоковое чтение файла с ключами: строки отдаются по одной и не держатся в памяти.
+# CSV - колонки key_value, name, validity_period (заголовок необязателен, тогда
+# первая колонка - значение, вторая - название); TXT - по ключу на строку;
+# ZIP - каждый файл архива - конфигурация, название ключа = имя файла.
+# Пропущенные (пустые/слишком длинные/с неверным сроком) строки считаются в skipped.
+class KeyFileReader:
+    def __init__(self, path: str, filename: str, default_name: str):
+        self.path = path
+        self.filename = filename
+        self.default_name = default_name
+        self.skipped = 0
+        self.extension = os.path.splitext(filename)[1].lower()
+        if self.extension not in IMPORT_FORMATS:
+            raise ValueError(f"Поддерживаются файлы {', '.join(IMPORT_FORMATS)}")
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.extension == ".zip":
+            return self._read_zip()
+        if self.extension == ".csv":
+            return self._read_csv()
+        return self._read_txt()
+
+    def _row(self, key_value: str, name: str | None=None, validity_period: str | None=None, number: int=0) -> dict | None:
+        key_value = (key_value or "").strip()
+        if not key_value or len(key_value) > MAX_KEY_LENGTH:
+            self.skipped += 1
+            return None
+        period = None
+        if validity_period and validity_period.strip() not in ("", "-"):
+            try:
+                period = int(validity_period)
+            except ValueError:
+                period = 0
+            if period <= 0:
+                self.skipped += 1
+                return None
+        name = (name or "").strip() or f"{self.default_name} #{number}"
+        return {"name": name[:MAX_NAME_LENGTH], "key_value": key_value, "validity_period": period}
+
+    def _read_txt(self):
+        with open(self.path, encoding="utf-8-sig", errors="replace") as file:
+            for number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                row = self._row(line, number=number)
+                if row:
+                    yield row
+
+    def _read_csv(self):
+        with open(self.path, encoding="utf-8-sig", errors="replace", newline="") as file:
+            reader = csv.reader(file)
+            columns = ["key_value", "name", "validity_period"]
+            for number, record in enumerate(reader, start=1):
+                if number == 1 and "key_value" in (cell.strip().lower() for cell in record):
+                    columns = [cell.strip().lower() for cell in record]
+                    continue
+                if not any(cell.strip() for cell in record):
+                    continue
+                values = dict(zip(columns, record))
+                row = self._row(
+                    values.get("key_value"),
+                    name=values.get("name"),
+                    validity_period=values.get("validity_period"),
+                    number=number,
+                )
+                if row:
+                    yield row
+
+    def _read_zip(self):
+        with zipfile.ZipFile(self.path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.file_size > MAX_KEY_LENGTH:
+                    self.skipped += 1
+                    continue
+                with archive.open(info) as entry:
+                    content = io.TextIOWrapper(entry, encoding="utf-8-sig", errors="replace").read()
+                row = self._row(content, name=os.path.basename(info.filename))
+                if row:
+                    yield row
@@ -0,0 +1,36 @@
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.orm_query import NOTICE_EXPIRED, orm_get_due_expiry_notices, orm_mark_notices_sent
+from utils.outbound import outbound
+
+# Сколько уведомлений ставить в очередь отправки за один запуск задачи
+NOTICE_BATCH_SIZE = 200
+
+
+def expiry_notice_text(key_name: str, product_name: str, expiration_date, kind: str) -> str:
+    expiration = expiration_date.strftime('%Y-%m-%d %H:%M:%S UTC')
+    if kind == NOTICE_EXPIRED:
+        state = f"истёк {expiration}"
+    else:
+        state = f"истекает {expiration}"
+    return (
+        "Уважаемый пользователь!\n"
+        f"Срок действия вашего ключа '{key_name}' для товара '{product_name}' {state}.\n"
+        "Для продления обратитесь к администратору."
+    )
+
+
+# Фоновая задача (utils.periodic): рассылка уведомлений об окончании срока ключей.
+# Уведомления уходят через очередь outbound с её ограничением скорости и сразу
+# отмечаются в key_notice, поэтому повторно по тому же окну не отправляются.
+async def send_expiry_notices(session: AsyncSession) -> int:
+    rows = await orm_get_due_expiry_notices(session, limit=NOTICE_BATCH_SIZE)
+    if not rows:
+        return 0
+    for key_id, user_id, key_name, product_name, expiration_date, kind in rows:
+        outbound.send_message(user_id, expiry_notice_text(key_name, product_name, expiration_date, kind))
+    await orm_mark_notices_sent(session, [(row.id, row.kind) for row in rows])
+    logging.info(f"Поставлено в очередь уведомлений об окончании срока ключей: {len(rows)}")
+    return len(rows)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from utils.cache import LRUCache
+
+
+# Ведро токенов: rate токенов в секунду, не больше capacity подряд
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        # Сколько ждать до следующего токена; 0 - токен взят, можно отправлять
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        # Telegram попросил подождать (RetryAfter)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+@dataclass
+class OutboundJob:
+    method: str
+    chat_id: int
+    kwargs: dict
+    enqueued: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+    future: asyncio.Future | None = None
+
+
+# Очередь исходящих сообщений бота с ограничением скорости: не больше global_rate
+# сообщений в секунду на всех и chat_rate сообщений в секунду в один чат
+# (лимиты Telegram ~30 msg/s и ~1 msg/s). Хендлеры ставят сообщение в очередь и сразу
+# возвращаются; RetryAfter и сетевые ошибки обрабатываются повторной отправкой.
+# Сообщения в один чат уходят строго в порядке постановки в очередь.
+class OutboundQueue:
+    def __init__(
+        self,
+        global_rate: float=30,
+        chat_rate: float=1,
+        workers: int=4,
+        max_attempts: int=5,
+        backoff: float=1.0,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.bot: Bot | None = None
+
+        self._chats: dict[int, deque[OutboundJob]] = {}
+        # Вёдра недавно активных чатов; давно молчавшие вытесняются
+        self._chat_buckets = LRUCache(maxsize=10000)
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+        # Метрики
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._latency_sum = 0.0
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout: float=5.0):
+        # Даём очереди досылать накопленное, но не дольше timeout секунд
+        deadline = time.monotonic() + timeout
+        while self.depth and self._tasks and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def enqueue(self, method: str, chat_id: int, **kwargs: Any) -> asyncio.Future:
+        # Возвращает future с результатом отправки; ждать его не обязательно
+        job = OutboundJob(method, chat_id, kwargs, future=asyncio.get_running_loop().create_future())
+        chat_jobs = self._chats.get(chat_id)
+        if chat_jobs is None:
+            self._chats[chat_id] = deque([job])
+            self._ready.put_nowait(chat_id)
+        else:
+            chat_jobs.append(job)
+        self.depth += 1
+        return job.future
+
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> asyncio.Future:
+        return self.enqueue("send_message", chat_id, text=text, **kwargs)
+
+    def send_document(self, chat_id: int, document: Any, **kwargs: Any) -> asyncio.Future:
+        return self.enqueue("send_document", chat_id, document=document, **kwargs)
+
+    def send_photo(self, chat_id: int, photo: Any, **kwargs: Any) -> asyncio.Future:
+        return self.enqueue("send_photo", chat_id, photo=photo, **kwargs)
+
+    def send_media_group(self, chat_id: int, media: list, **kwargs: Any) -> asyncio.Future:
+        return self.enqueue("send_media_group", chat_id, media=media, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "last_latency": round(self.last_latency, 3),
+            "avg_latency": round(self._latency_sum / self.sent, 3) if self.sent else 0.0,
+            "max_latency": round(self.max_latency, 3),
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, 1)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _reschedule(self, chat_id: int, delay: float):
+        # Чат вернётся в очередь готовых через delay секунд, воркер при этом свободен
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            delay = self._chat_bucket(chat_id).delay()
+            if delay > 0:
+                self._reschedule(chat_id, delay)
+                continue
+            while (delay := self.global_bucket.delay()) > 0:
+                await asyncio.sleep(delay)
+            await self._send(chat_id, self._chats[chat_id][0])
+
+    async def _send(self, chat_id: int, job: OutboundJob):
+        try:
+            result = await getattr(self.bot, job.method)(chat_id, **job.kwargs)
+        except TelegramRetryAfter as e:
+            self.retries += 1
+            self._chat_bucket(chat_id).block(e.retry_after)
+            self.global_bucket.block(e.retry_after)
+            self._reschedule(chat_id, e.retry_after)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            job.attempts += 1
+            if job.attempts < self.max_attempts:
+                self.retries += 1
+                self._reschedule(chat_id, self.backoff * 2 ** (job.attempts - 1))
+                return
+            self._finish(chat_id, job, error=e)
+        except Exception as e:
+            self._finish(chat_id, job, error=e)
+        else:
+            self._finish(chat_id, job, result=result)
+        self._next(chat_id)
+
+    def _finish(self, chat_id: int, job: OutboundJob, result: Any=None, error: Exception | None=None):
+        self._chats[chat_id].popleft()
+        self.depth -= 1
+        if error is not None:
+            self.failed += 1
+            logging.error(f"Не удалось отправить {job.method} в чат {chat_id}: {error}")
+            if not job.future.done():
+                job.future.set_exception(error)
+                # Исключение считается полученным, даже если future никто не ждёт
+                job.future.exception()
+            return
+        self.sent += 1
+        latency = time.monotonic() - job.enqueued
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._latency_sum += latency
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _next(self, chat_id: int):
+        if self._chats[chat_id]:
+            self._ready.put_nowait(chat_id)
+        else:
+            del self._chats[chat_id]
+
+
+outbound = OutboundQueue()
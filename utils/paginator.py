@@ -40,4 +40,51 @@ class Paginator:
         if self.page > 1:
             self.page -= 1
             return self.__get_slice()
-        raise IndexError(f'Previous page does not exist. Use has_previous() to check before.')
\ No newline at end of file
+        raise IndexError(f'Previous page does not exist. Use has_previous() to check before.')
+
+
+# Пагинатор поверх SQL-запроса: из БД читается только текущая страница (LIMIT/OFFSET),
+# общее количество передаётся снаружи (обычно из кэша счётчиков в orm_query)
+# Если передан row_type, строки запроса (выборка колонок) собираются в объекты row_type
+class QueryPaginator:
+    def __init__(self, session, query, total: int, page: int=1, per_page: int=1, row_type=None):
+        self.session = session
+        self.query = query
+        self.row_type = row_type
+        self.per_page = per_page
+        self.page = page
+        self.len = total
+        self.pages = math.ceil(self.len / self.per_page)
+
+    async def __get_slice(self):
+        start = (self.page - 1) * self.per_page
+        result = await self.session.execute(self.query.limit(self.per_page).offset(start))
+        if self.row_type is not None:
+            return [self.row_type(*row) for row in result]
+        return result.scalars().all()
+
+    async def get_page(self):
+        page_items = await self.__get_slice()
+        return page_items
+
+    def has_next(self):
+        if self.page < self.pages:
+            return self.page + 1
+        return False
+
+    def has_previous(self):
+        if self.page > 1:
+            return self.page - 1
+        return False
+
+    async def get_next(self):
+        if self.page < self.pages:
+            self.page += 1
+            return await self.get_page()
+        raise IndexError(f'Next page does not exist. Use has_next() to check before.')
+
+    async def get_previous(self):
+        if self.page > 1:
+            self.page -= 1
+            return await self.__get_slice()
+        raise IndexError(f'Previous page does not exist. Use has_previous() to check before.')
@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+
+# Фоновые задачи бота, которые выполняются раз в interval секунд.
+# Каждый запуск задачи получает свою сессию БД; ошибка одного запуска
+# логируется и не останавливает следующие.
+class PeriodicJobs:
+    def __init__(self):
+        self._jobs: list[tuple[str, float, Callable[[AsyncSession], Awaitable]]] = []
+        self._tasks: list[asyncio.Task] = []
+
+    def add(self, name: str, interval: float, job: Callable[[AsyncSession], Awaitable]):
+        self._jobs.append((name, interval, job))
+
+    def start(self, session_pool: async_sessionmaker):
+        for name, interval, job in self._jobs:
+            self._tasks.append(asyncio.create_task(self._run(name, interval, job, session_pool)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _run(self, name: str, interval: float, job, session_pool: async_sessionmaker):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with session_pool() as session:
+                    await job(session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Фоновая задача '{name}' завершилась с ошибкой: {e}")
+
+
+periodic_jobs = PeriodicJobs()
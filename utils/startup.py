@@ -0,0 +1,25 @@
+import time
+from contextlib import asynccontextmanager
+
+
+# Замер шагов запуска бота: сколько занял каждый шаг и весь запуск с момента импорта
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps: list[tuple[str, float]] = []
+
+    @asynccontextmanager
+    async def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started))
+
+    def report(self) -> str:
+        lines = [f"  {name}: {seconds * 1000:.0f} мс" for name, seconds in self.steps]
+        total = time.perf_counter() - self.started
+        return "Запуск бота:\n" + "\n".join(lines) + f"\n  всего: {total * 1000:.0f} мс"
+
+
+startup_timer = StartupTimer()